@@ -1,4 +1,4 @@
-import env, deploy, shell, setup
+import env, deploy, shell, setup, bench, artifact
 
 
 __version__ = (0, 1, 4)
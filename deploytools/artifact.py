@@ -0,0 +1,139 @@
+import os
+import posixpath
+
+import fabric.api as fabric
+from fabric import colors
+
+from .utils import root_path, requires_config, dir_exists
+from .utils.distribution import seed_release, pinned_release
+from .utils.trace import traced
+from .setup import virtualenv_command, link_dist_packages
+
+
+__all__ = ["build"]
+
+
+def local_artifact_path(sha):
+    cache = os.path.expanduser(fabric.env.cfg.artifact_cache)
+    return os.path.join(cache, "{}-{}.tar.gz".format(fabric.env.cfg.app_name,
+        sha))
+
+
+def builder_host():
+    return fabric.env.cfg.artifact_builder or fabric.env.hosts[0]
+
+
+def build_django_run(build, venv, *args):
+    """Run django-admin against a build tree instead of current
+    """
+    command = [root_path("bin/run")] + list(args)
+
+    with fabric.shell_env(RELEASE=build, VENV=venv), fabric.cd(build):
+        fabric.run(" ".join(command))
+
+
+@traced
+def build_on_host(ref, sha):
+    """Build the artifact for a SHA on the current host
+
+    The code tree is exported to shared/build/<sha>, every requirement is
+    built into its wheelhouse directory and a throwaway virtualenv with
+    those wheels runs collectstatic and the docs build. The tree without
+    the virtualenv is then packed into shared/build/<sha>.tar.gz and its
+    path returned.
+    """
+    build = root_path("shared/build", sha)
+    archive = "{}.tar.gz".format(build)
+    venv = posixpath.join(build, ".build-venv")
+    wheelhouse = posixpath.join(build, "wheelhouse")
+    cache = root_path(".pip_cache/wheelhouse")
+
+    fabric.run("rm -rf {0} && mkdir -p {0} {1} {2}".format(build, wheelhouse,
+        cache))
+
+    with fabric.cd(root_path("shared/repo")):
+        fabric.run("git archive {} | tar -C {} -xf -".format(sha, build))
+
+    fabric.run(virtualenv_command(venv))
+    link_dist_packages(venv)
+
+    pip = posixpath.join(venv, "bin", "pip")
+
+    with fabric.cd(build):
+        fabric.run("{} install -q wheel".format(pip))
+        fabric.run("{} wheel -q --wheel-dir {} --find-links {} "
+                "-r requirements.txt".format(pip, cache, cache))
+        fabric.run("{} wheel -q --no-index --find-links {} --wheel-dir {} "
+                "-r requirements.txt".format(pip, cache, wheelhouse))
+        fabric.run("{} install -q --no-index --find-links {} "
+                "-r requirements.txt".format(pip, wheelhouse))
+
+    build_django_run(build, venv, "collectstatic", "--noinput", "-v 0")
+
+    if dir_exists(posixpath.join(build, "doc")):
+        with fabric.cd(build):
+            fabric.run("{} install -q sphinx".format(pip))
+            fabric.run("{}/bin/sphinx-build -b html -d doc/_build/doctrees "
+                    "doc/ doc/_build/html".format(venv))
+
+    fabric.run("echo {} {} > {}/.artifact".format(ref, sha, build))
+    fabric.run("rm -rf {0} && tar -czf {1} -C {2} . && rm -rf {2}".format(venv,
+        archive, build))
+
+    return archive
+
+
+@traced
+def fetch_and_build(ref, sha):
+    """Fetch the release on the builder, build it and cache the artifact
+    """
+    path = local_artifact_path(sha)
+
+    seed_release(ref, sha)
+    archive = build_on_host(ref, sha)
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    fabric.get(archive, path + ".part")
+    os.rename(path + ".part", path)
+    fabric.run("rm -f {}".format(archive))
+
+
+def build_artifact():
+    """Make sure the pinned release is built and cached locally
+
+    The artifact for a SHA is only built the first time it is deployed, on
+    the builder host, afterwards the locally cached copy is reused.
+    Returns the local path, ref and SHA.
+    """
+    ref, sha = pinned_release()
+
+    if not os.path.exists(local_artifact_path(sha)):
+        fabric.execute(fetch_and_build, ref, sha, hosts=[builder_host()])
+
+    print colors.yellow("Release artifact for {} ({}) ready".format(ref,
+        sha[:12]))
+
+    return local_artifact_path(sha), ref, sha
+
+
+def unpack_artifact(path, release_dir):
+    """Upload a cached artifact and unpack it as the release directory
+    """
+    upload = "{}.tar.gz".format(release_dir)
+
+    fabric.put(path, upload)
+    fabric.run("mkdir -p {0} && tar -xzf {1} -C {0} && rm -f {1}".format(
+        release_dir, upload))
+
+
+@fabric.task
+@fabric.runs_once
+@requires_config
+@traced
+def build():
+    """Build and cache the release artifact without deploying it
+    """
+    path, _, _ = build_artifact()
+    print path
@@ -0,0 +1,311 @@
+import os
+import sys
+import time
+import stat
+import getpass
+import tempfile
+import subprocess
+
+import fabric.api as fabric
+from fabric import colors
+
+from .utils import AttrDict, get_release_dir, print_center, format_bytes
+from .utils.trace import install_tracer, summarize_trace
+from .utils.transport import LocalTransport, install_transport
+from .deploy import deploy_host, prepare_rollback, rollback_host
+from .setup import setup_host
+
+
+__all__ = ["pipeline"]
+
+
+FAKE_VIRTUALENV = """#!/bin/bash
+# Fake virtualenv, the target path is always the last argument
+for target; do :; done
+mkdir -p "$target/bin" "$target/lib/python2.7/site-packages"
+cp "$(dirname "$0")"/venv/* "$target/bin/"
+"""
+
+FAKE_PYTHON = """#!/bin/bash
+echo "Python 2.7"
+"""
+
+FAKE_PIP = """#!/bin/bash
+exit 0
+"""
+
+# The virtualenv's python is the real interpreter, so warmup compiles and
+# imports the synthetic project for real
+FAKE_VENV_PYTHON = """#!/bin/bash
+exec {} "$@"
+"""
+
+FAKE_ENVRUN = """#!/bin/bash
+shift
+exec "$@"
+"""
+
+# Stands in for Django, migrations are the numbered files in each app's
+# migrations directory and applied ones are tracked under ~/.fake_db.
+# Migrating to a target unapplies the migrations after it and, like South,
+# the target has to be an exact migration name or a unique prefix of one.
+FAKE_DJANGO_ADMIN = """#!/bin/bash
+release="${PYTHONPATH%%:*}"
+db="$HOME/.fake_db"
+command="$1"
+shift
+
+case "$command" in
+migrate)
+    list=
+    app=
+    target=
+    for arg; do
+        case "$arg" in
+        --list) list=1 ;;
+        -*) ;;
+        *) if [ -z "$app" ]; then app="$arg"; else target="$arg"; fi ;;
+        esac
+    done
+
+    for dir in "$release"/*/migrations; do
+        [ -d "$dir" ] || continue
+        name=$(basename "$(dirname "$dir")")
+        [ -n "$app" ] && [ "$app" != "$name" ] && continue
+        [ -n "$list" ] && echo "$name"
+        names=$(ls "$dir" | grep '^[0-9].*\\.py$' | sed 's/\\.py$//' | sort)
+
+        if [ -n "$target" ] && [ "$target" != zero ]; then
+            found=$(echo "$names" | grep -x -F "$target" ||
+                echo "$names" | grep "^$target")
+
+            if [ "$(echo "$found" | grep -c .)" != 1 ]; then
+                echo "No unique migration $target in $name" >&2
+                exit 1
+            fi
+
+            target="$found"
+        fi
+
+        for migration in $names; do
+            if [ -n "$list" ]; then
+                [ -e "$db/$name/$migration" ] && echo " (*) $migration" \\
+                    || echo " ( ) $migration"
+            elif [ -n "$target" ] && { [ "$target" = zero ] ||
+                    [[ "$migration" > "$target" ]]; }; then
+                if [ -e "$db/$name/$migration" ]; then
+                    echo " < $name:$migration"
+                    rm -f "$db/$name/$migration"
+                fi
+            elif [ ! -e "$db/$name/$migration" ]; then
+                echo " > $name:$migration"
+                mkdir -p "$db/$name"
+                touch "$db/$name/$migration"
+            fi
+        done
+    done
+    ;;
+collectstatic)
+    mkdir -p "$release/serve_static"
+    for dir in "$release"/*/static; do
+        [ -d "$dir" ] && cp -R --remove-destination "$dir/." \\
+            "$release/serve_static/"
+    done
+    ;;
+esac
+"""
+
+
+def _write_script(path, content):
+    with open(path, "w") as fp:
+        fp.write(content)
+
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def make_fake_bin(path):
+    """Create the stand-in executables the fake hosts run
+    """
+    os.makedirs(os.path.join(path, "venv"))
+
+    _write_script(os.path.join(path, "virtualenv"), FAKE_VIRTUALENV)
+    _write_script(os.path.join(path, "python2.7"), FAKE_PYTHON)
+    _write_script(os.path.join(path, "venv", "pip"), FAKE_PIP)
+    _write_script(os.path.join(path, "venv", "envrun"), FAKE_ENVRUN)
+    _write_script(os.path.join(path, "venv", "python"),
+            FAKE_VENV_PYTHON.format(sys.executable))
+    _write_script(os.path.join(path, "venv", "django-admin.py"),
+            FAKE_DJANGO_ADMIN)
+
+    return path
+
+
+def _git(repo, *args):
+    subprocess.check_call(["git", "-c", "user.name=bench",
+        "-c", "user.email=bench@localhost"] + list(args), cwd=repo,
+        stdout=open(os.devnull, "w"))
+
+
+def _write_file(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, "w") as fp:
+        fp.write(content)
+
+
+def make_repo(path, app_name, files, revision=0):
+    """Create or update a synthetic project with roughly `files` files
+
+    Every tenth file is a static asset. Each revision rewrites a tenth of
+    the modules and adds a migration, like a typical release.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        _git(path, "init", "-q")
+        _git(path, "symbolic-ref", "HEAD", "refs/heads/master")
+
+    app = os.path.join(path, app_name)
+
+    _write_file(os.path.join(path, "requirements.txt"), "")
+    _write_file(os.path.join(app, "__init__.py"), "")
+    _write_file(os.path.join(app, "settings.py"), "DEBUG = False\n")
+    _write_file(os.path.join(app, "wsgi.py"), "application = None\n")
+    _write_file(os.path.join(app, "migrations", "__init__.py"), "")
+    _write_file(os.path.join(app, "migrations",
+        "{:04d}_Revision.py".format(revision + 1)), "")
+
+    for number in range(files):
+        changed = revision if number % 10 == revision % 10 else 0
+
+        if number % 10 == 0:
+            name = os.path.join(app, "static", "js",
+                    "asset{}.js".format(number))
+        else:
+            name = os.path.join(app, "pkg{}".format(number // 100),
+                    "module{}.py".format(number))
+
+        _write_file(name, "# revision {}\n{}\n".format(changed,
+            "x = {}\n".format(number) * 40))
+
+    _git(path, "add", "-A")
+    _git(path, "commit", "-q", "-m", "revision {}".format(revision))
+
+
+def _run_on_bench_host(func, configs):
+    fabric.env.cfg = configs[fabric.env.host_string]
+    fabric.env.release_dir = get_release_dir()
+    return func()
+
+
+def _rollback_host():
+    """Roll the host back to the previous release, migrations included
+
+    Every bench host has its own fake database, so unlike rollback the
+    reverse migrations run on each of them.
+    """
+    # Not part of a deploy, so nothing should run against a new release
+    with fabric.settings(release_dir=None):
+        rollback_host(prepare_rollback("previous"))
+
+
+def _run_scenario(name, func, hosts, configs, trace_dir, parallel):
+    trace_file = os.path.join(trace_dir, "{}-{}.json".format(name,
+        len(hosts)))
+    install_tracer(trace_file)
+
+    # Resolved again by the first host, the repo changes between scenarios
+    fabric.env.pinned_release = None
+
+    start = time.time()
+    with fabric.settings(parallel=parallel, pool_size=len(hosts)):
+        fabric.execute(_run_on_bench_host, func, configs, hosts=hosts)
+    wall = time.time() - start
+
+    totals = summarize_trace(trace_file).values()
+
+    return {
+        "scenario": name,
+        "wall": wall,
+        "round_trips": sum(t["round_trips"] for t in totals),
+        "bytes": sum(t["bytes_sent"] + t["bytes_received"] for t in totals),
+    }
+
+
+@fabric.task
+@fabric.runs_once
+def pipeline(fleets="1/4", files="100/1000", latency="0.01",
+        parallel="true", keep="false", **options):
+    """Benchmark setup, deploy and rollback against local fake hosts
+
+    fleets and files are /-separated lists of fleet sizes and synthetic
+    repository sizes; every combination is run. latency is the simulated
+    per-operation delay in seconds. Any other argument is passed on as a
+    config key, e.g. incremental_releases=true.
+    """
+    base = tempfile.mkdtemp(prefix="deploy-bench-")
+    transport = install_transport(LocalTransport(base, latency,
+        path=os.pathsep.join([make_fake_bin(os.path.join(base, "fakebin")),
+            os.environ.get("PATH", "/usr/bin:/bin")])))
+
+    fabric.env.user = getpass.getuser()
+    fabric.env.environment_name = "bench"
+
+    results = []
+
+    for file_count in [int(i) for i in files.split("/")]:
+        for host_count in [int(i) for i in fleets.split("/")]:
+            scenario_dir = os.path.join(base, "{}-{}".format(file_count,
+                host_count))
+            repo = os.path.join(scenario_dir, "repo")
+            transport.sandbox = os.path.join(scenario_dir, "hosts")
+
+            fleet = ["bench{}".format(i) for i in range(host_count)]
+            configs = {}
+
+            for host in fleet:
+                configs[host] = AttrDict(options,
+                    app_name="benchapp",
+                    user=fabric.env.user,
+                    repo=repo,
+                    server_name="bench.local",
+                    root=os.path.join(transport.host_root(host), "app"),
+                    processes={})
+
+                os.makedirs(os.path.join(transport.host_root(host), ".ssh"))
+
+            make_repo(repo, "benchapp", file_count)
+
+            with fabric.hide("everything"):
+                row = {"files": file_count, "hosts": host_count}
+
+                for name, func, revision in [("setup", setup_host, None),
+                        ("deploy", deploy_host, None),
+                        ("redeploy", deploy_host, 1),
+                        ("rollback", _rollback_host, None)]:
+                    if revision:
+                        make_repo(repo, "benchapp", file_count, revision)
+                        # Release directories have one second resolution
+                        time.sleep(1)
+
+                    row.update(_run_scenario(name, func, fleet, configs,
+                        scenario_dir, parallel == "true"))
+                    results.append(dict(row))
+
+    print "=" * 80
+    print_center("DEPLOY BENCHMARK (latency {}s)", latency)
+    print "=" * 80
+    print "{:<10} {:>7} {:>6} {:>10} {:>12} {:>10}".format("scenario",
+            "files", "hosts", "wall", "round trips", "bytes")
+
+    for row in results:
+        print "{:<10} {:>7} {:>6} {:>9.2f}s {:>12} {:>10}".format(
+                row["scenario"], row["files"], row["hosts"], row["wall"],
+                row["round_trips"], format_bytes(row["bytes"]))
+
+    print "=" * 80
+
+    if keep == "true":
+        print colors.yellow("Sandbox kept in {}".format(base))
+    else:
+        subprocess.call(["rm", "-rf", base])
@@ -7,6 +7,7 @@ DIRECTORIES = [
     ("shared/log", 770, "{user}:www-data"),
     ("shared/run", None, None),
     ("shared/config", None, None),
+    ("shared/envs", None, None),
 ]
 
 DIST_PACKAGES = {
@@ -30,8 +31,8 @@ DEFAULT_PROCESSES = {
 }
 
 BINSTUB_RUNNER = (
-    "{root}/shared/system/bin/envrun "
+    "$VENV/bin/envrun "
     "{root}/shared/secrets/environ.cfg "
-    "{root}/shared/system/bin/django-admin.py ")
+    "$VENV/bin/django-admin.py ")
 
 VIRTUALENV_CMD = "virtualenv --python=python{python} {pkgs_flag} {path}"
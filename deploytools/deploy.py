@@ -1,25 +1,56 @@
+import os
+import time
+import posixpath
+from collections import OrderedDict
+
 from fabric import colors
 import fabric.api as fabric
-from fabric.contrib.files import upload_template
 
-from .utils import (local_path, root_path, get_prior_release,
-        all_processes_sudo, dir_exists, friendly_release_dir, print_center,
-        mkdir, requires_config, get_release_ref, get_release_dir, django_run,
-        pip_run)
+from .utils import (local_path, root_path, all_processes_sudo,
+        process_sudo, dir_exists, friendly_release_dir, print_center,
+        mkdir, requires_config, get_release_dir,
+        django_run, django_env, pip_run, split_batches, test_cmd,
+        get_current_release, switch_symlink, format_bytes, release_path,
+        release_venv)
 
 from .utils.migrations import (get_release_meta, MigrationRollback,
-        get_release_manifest, parse_migrations)
+        MigrationState, get_release_manifest, parse_migrations,
+        get_remote_manifest, parse_migration_timings, get_rollback_plan,
+        load_rollback_plan)
+
+from .utils.distribution import (distribute_release, resolve_release,
+        pinned_release, fetch_release)
+from .utils.connections import connection_stats, print_connection_stats
+from .utils.pipeline import Pipeline
+from .utils.gunicorn import graceful_reload
+from .utils.releases import (list_releases, prunable_releases,
+        read_release_index, write_release_index, get_prior_release,
+        release_date)
+from .utils.wheels import local_wheelhouse
+from .utils.sync import file_sync
+from .utils.trace import traced
+
+from .setup import setup_host, virtualenv_command, link_dist_packages
+from .artifact import build_artifact, unpack_artifact
 
 
-__all__ = ["promote", "prune", "rollback", "info", "build_docs", "deploy"]
+__all__ = [
+    "promote", "prune", "rollback", "info", "build_docs", "deploy",
+    "rolling_deploy",
+]
 
 
 @fabric.task
 @requires_config
+@traced
 def build_docs():
     """Build documentation
     """
-    with fabric.cd(root_path("current")):
+    # Artifacts already contain the built docs
+    if fabric.env.get("release_artifact"):
+        return
+
+    with fabric.cd(release_path()):
         if not dir_exists("doc"):
             return
 
@@ -28,128 +59,671 @@ def build_docs():
                 "doc/ doc/_build/html")
 
 
+def load_previous_release():
+    """Record the release current points at and its parsed manifest
+    """
+    fabric.env.previous_release = get_current_release()
+    fabric.env.previous_meta = None
+
+    fabric.env.previous_manifest = None
+
+    if fabric.env.previous_release:
+        manifest = get_remote_manifest(fabric.env.previous_release)
+
+        if manifest:
+            fabric.env.previous_manifest = manifest
+            fabric.env.previous_meta = get_release_meta(manifest)
+
+
+def get_previous_sha():
+    """Return the SHA of the previous release if the repo still has it
+    """
+    if not fabric.env.previous_meta:
+        return None
+
+    sha = fabric.env.previous_meta["sha"]
+
+    if not test_cmd("git cat-file -e {}^{{commit}}".format(sha)):
+        return None
+
+    return sha
+
+
+def export_release():
+    """Export the whole tree of the deployed ref into the release directory
+    """
+    mkdir(fabric.env.release_dir)
+
+    fabric.run("git archive {} | tar -C {} -xf -".format(
+        fabric.env.deployed_sha, fabric.env.release_dir))
+
+
+def export_incremental_release(previous, previous_sha):
+    """Seed the release directory from the previous release
+
+    Only files tracked at the previous SHA are hardlinked (or reflinked,
+    see release_copy_mode) so generated files such as bytecode, docs and
+    the manifest are never shared between releases. Files that changed
+    between the two SHAs are unlinked and rewritten from git so the previous
+    release is never modified. Must run from within the repo.
+    """
+    if fabric.env.cfg.release_copy_mode == "reflink":
+        copy = "cp -a --reflink=auto"
+    else:
+        copy = "cp -al"
+
+    args = {
+        "copy": copy,
+        "old": previous,
+        "new": fabric.env.release_dir,
+        "old_sha": previous_sha,
+        "sha": fabric.env.deployed_sha,
+        "diff": "git diff -z --name-only --no-renames",
+    }
+
+    fabric.run(" && ".join([
+        "set -o pipefail",
+        "export GIT_LITERAL_PATHSPECS=1",
+        "mkdir -p {new}",
+        "git ls-tree -r -z --name-only {old_sha} | "
+            "(cd {old} && xargs -0 -r {copy} --parents -t {new})",
+        "{diff} {old_sha} {sha} | (cd {new} && xargs -0 -r rm -f)",
+        "{diff} --diff-filter=d {old_sha} {sha} | "
+            "xargs -0 -r git archive {sha} -- | tar -C {new} -xif -",
+    ]).format(**args))
+
+
 @fabric.task
+@traced
 def update_code():
-    """Clone (or fetch from) a git repo and export a copy
-
-    Clones the git repo if it doesn't exist and then exports the release ref to
-    the release directory.
+    """Fetch the release from git and export a copy
+
+    Fetches the pinned release SHA (see resolve_release) into the repo,
+    shallow, and then exports it to the release directory. With
+    incremental_releases enabled the release is seeded from the previous
+    one and only the changed files are written. When the release was
+    already distributed to the hosts (see release_distribution) nothing is
+    fetched from origin, with release_artifacts the prebuilt artifact is
+    unpacked instead.
     """
-    repo_path = root_path("shared/repo")
+    load_previous_release()
+
+    if fabric.env.get("release_artifact"):
+        path, fabric.env.deployed_ref, fabric.env.deployed_sha = \
+                fabric.env.release_artifact
+        return unpack_artifact(path, fabric.env.release_dir)
+
+    fabric.env.deployed_ref, fabric.env.deployed_sha = pinned_release()
+
+    if not fabric.env.get("distributed_release"):
+        fetch_release(fabric.env.deployed_sha)
+
+    with fabric.cd(root_path("shared/repo")):
+        previous_sha = None
 
-    if not dir_exists(repo_path):
-        fabric.run("git clone -nq {} {}".format(fabric.env.cfg.repo, repo_path))
+        if fabric.env.cfg.get_bool("incremental_releases"):
+            previous_sha = get_previous_sha()
 
-    with fabric.cd(repo_path):
-        fabric.run("git fetch origin")
-        fabric.run("git fetch --tags origin")
+        if previous_sha:
+            export_incremental_release(fabric.env.previous_release,
+                    previous_sha)
+        else:
+            export_release()
+
+
+def switch_virtualenv(release):
+    """Point shared/system at the keyed virtualenv a release was built with
+
+    Releases without a keyed virtualenv leave shared/system alone. A plain
+    shared/system directory left by setup is moved into shared/envs the
+    first time so it can be replaced by a symlink.
+    """
+    venv_link = posixpath.join(release, ".venv")
+    system = root_path("shared/system")
+
+    venv = fabric.run("readlink {}".format(venv_link), warn_only=True,
+            quiet=True)
 
-        fabric.env.deployed_ref = get_release_ref()
-        fabric.env.deployed_sha = fabric.run("git show-ref --hash {}".format(
-            fabric.env.deployed_ref))
+    if not venv.succeeded:
+        return
 
-        mkdir(fabric.env.release_dir)
+    # A concurrent switch may have moved it first
+    fabric.run("test -L {0} || ! test -d {0} || mv -T {0} {1} || test -L {0}"
+            .format(system, root_path("shared/envs/legacy")))
 
-        fabric.run("git archive {} | tar -C {} -xf -".format(
-            fabric.env.deployed_ref, fabric.env.release_dir))
+    switch_symlink(str(venv).strip(), system)
 
 
 @fabric.task
+@traced
 def link_release(release=None):
     """Link current release directory to current release
+
+    current is replaced atomically, it always points at a full release.
     """
     if not release:
         release = fabric.env.release_dir
 
-    with fabric.cd(fabric.env.cfg.root):
-        fabric.run("rm current", warn_only=True, quiet=True)
-        fabric.run("ln -s {} current".format(release))
+    switch_symlink(release, root_path("current"))
+    switch_virtualenv(release)
+
+
+def get_requirements_key():
+    """Hash requirements.txt together with the interpreter it targets
+    """
+    with fabric.cd(fabric.env.release_dir):
+        return str(fabric.run(
+            "(cat requirements.txt; python{} -V 2>&1; echo {}) "
+            "| sha1sum | cut -c1-16".format(fabric.env.cfg.python_version,
+                fabric.env.cfg.site_packages), quiet=True)).strip()
+
+
+def build_keyed_virtualenv(wheelhouse=None):
+    """Build or reuse the virtualenv keyed by the release's requirements
+
+    Virtualenvs live in shared/envs/<key> and are only marked complete
+    once every requirement has been installed from the wheelhouse in
+    .pip_cache/wheelhouse, so a failed build is simply redone next time.
+    A release with unchanged requirements links the existing environment
+    and never runs pip. A prebuilt wheelhouse, such as the one shipped in
+    release artifacts, is installed from as is.
+    """
+    venv = root_path("shared/envs", get_requirements_key())
+
+    if not test_cmd("test -f {}/.complete".format(venv)):
+        fabric.run("rm -rf {}".format(venv))
+        fabric.run(virtualenv_command(venv))
+        link_dist_packages(venv)
+
+        if not wheelhouse:
+            wheelhouse = root_path(".pip_cache/wheelhouse")
+
+            pip_run("install", "-q", "wheel", venv=venv)
+            pip_run("wheel", "-q", "--wheel-dir", wheelhouse,
+                    "--find-links", wheelhouse, "-r", "requirements.txt",
+                    venv=venv)
+        pip_run("install", "-q", "--no-index", "--find-links", wheelhouse,
+                "-r", "requirements.txt", venv=venv)
+
+        fabric.run("touch {}/.complete".format(venv))
+
+    # shared/system follows once link_release makes the release current
+    fabric.run("ln -sfn {} {}".format(venv,
+        posixpath.join(fabric.env.release_dir, ".venv")))
+
+
+@traced
+def upload_wheels():
+    """Send the locally built wheels the host doesn't have yet
+    """
+    if not fabric.env.get("local_wheels"):
+        return
+
+    wheelhouse = root_path(".pip_cache/wheelhouse")
+    present = set(str(fabric.run("mkdir -p {0} && ls {0}".format(wheelhouse),
+        quiet=True)).split())
+
+    with file_sync() as sync:
+        for path in fabric.env.local_wheels:
+            name = os.path.basename(path)
+
+            if name not in present:
+                sync.file(path, posixpath.join(wheelhouse, name),
+                        compare=False)
 
 
 @fabric.task
+@traced
 def pip_install_requirements():
     """Install pip requirements
+
+    With keyed_virtualenvs enabled each distinct set of requirements gets
+    its own virtualenv instead of mutating shared/system in place. Release
+    artifacts and locally built wheels (local_wheels) are installed from
+    their wheelhouse without touching the index.
     """
+    wheelhouse = None
+
+    if fabric.env.get("release_artifact"):
+        wheelhouse = posixpath.join(fabric.env.release_dir, "wheelhouse")
+    elif fabric.env.get("local_wheels"):
+        wheelhouse = root_path(".pip_cache/wheelhouse")
+
+    if fabric.env.cfg.get_bool("keyed_virtualenvs"):
+        return build_keyed_virtualenv(wheelhouse)
+
+    if wheelhouse:
+        return pip_run("install", "-q", "--no-index", "--find-links",
+                wheelhouse, "-r", "requirements.txt")
+
     pip_run("install", "-q", "-r", "requirements.txt")
 
 
 @fabric.task
+@traced
+def get_migrations():
+    """Parse migrate --list once per deploy, sharing it with the manifest
+    """
+    if fabric.env.get("migrations") is None:
+        fabric.env.migrations = list(parse_migrations(str(
+            django_run("migrate", "--list", quiet=True))))
+
+    return fabric.env.migrations
+
+
+def timed_migrate(app, target=None, merge=False):
+    """Migrate one app, timing each migration it applies
+
+    Every output line is timestamped on the host so the durations only
+    measure the migrations themselves, not the round trip. A failed
+    migrate still fails the command, and with it the deploy.
+    """
+    command = [root_path("bin/run"), "migrate", app]
+
+    if target:
+        command.append(target)
+
+    if merge:
+        command.append("--merge")
+
+    command.append("--no-initial-data")
+
+    with fabric.shell_env(**django_env()):
+        output = fabric.run(
+            "{} 2>&1 | while IFS= read -r line; do "
+            "echo \"$(date +%s.%N) $line\"; done; "
+            "status=${{PIPESTATUS[0]}}; "
+            "echo \"$(date +%s.%N) __end__\"; "
+            "exit $status".format(" ".join(command)))
+
+    return parse_migration_timings(str(output))
+
+
+@fabric.task
+@traced
 def migrate():
     """Migrate the database
+
+    Only apps with unapplied migrations are migrated, one migrate call per
+    app (see MigrationState.forward_plan), and the step is skipped
+    entirely when nothing is pending. syncdb still runs when there is no
+    previous manifest or the set of migrated apps differs from it, since
+    that is when new tables may be needed. Timings for every applied
+    migration end up in the release manifest. With skip_migrate set in
+    env, as on every host a rolling deploy doesn't migrate from, only the
+    migration list is read for the manifest.
     """
-    if not fabric.env.cfg.get_bool("skip_syncdb"):
+    migrations = get_migrations()
+
+    if fabric.env.get("skip_migrate"):
+        print colors.green("Migrations run from another host, skipping "
+                "migrate")
+        return
+    state = MigrationState(migrations)
+    plan = state.forward_plan()
+
+    previous_apps = None
+    if fabric.env.get("previous_manifest"):
+        previous_apps = set(MigrationState.from_manifest(
+            fabric.env.previous_manifest).apps)
+
+    if (not fabric.env.cfg.get_bool("skip_syncdb") and
+            (plan or previous_apps != set(state.apps))):
         django_run("syncdb", "--noinput")
 
-    django_run("migrate", "--no-initial-data")
+    if not plan:
+        print colors.green("No pending migrations, skipping migrate")
+        return
+
+    timings = []
+    for app, target, merge in plan:
+        timings.extend(timed_migrate(app, target, merge))
+
+    migrated = set(app for app, _, _ in plan)
+
+    fabric.env.migration_timings = timings
+    fabric.env.migrations = [(app, name, installed or app in migrated)
+        for app, name, installed in migrations]
+
+
+def get_static_fingerprint():
+    """Hash the release's static sources and installed packages
+
+    Covers every file under a static directory in the release tree and the
+    output of pip freeze, since installed apps ship static files too.
+    """
+    with fabric.cd(fabric.env.release_dir):
+        return str(fabric.run(
+            "(find . -path ./{static_root} -prune -o -path '*/static/*' "
+            "-type f -print0 | sort -z | xargs -0 -r sha1sum; "
+            "{pip} freeze) | sha1sum | cut -d' ' -f1".format(
+                static_root=fabric.env.cfg.static_root,
+                pip=posixpath.join(release_venv(), "bin/pip")),
+            quiet=True)).strip()
 
 
 @fabric.task
+@traced
 def precompile_assets():
     """Precompile assets using Django collectstatic
+
+    With incremental_static enabled the static sources are fingerprinted
+    and the previous release's collected files are hardlinked in first.
+    A matching fingerprint skips collectstatic altogether, otherwise
+    collectstatic only replaces the files whose source is newer. That works
+    best together with incremental_releases, where unchanged sources keep
+    their original modification time.
     """
+    # Artifacts already contain the collected files
+    if fabric.env.get("release_artifact"):
+        return
+
+    if not fabric.env.cfg.get_bool("incremental_static"):
+        return django_run("collectstatic", "--noinput", "-v 0")
+
+    fabric.env.static_fingerprint = get_static_fingerprint()
+
+    previous = fabric.env.get("previous_release")
+    previous_meta = fabric.env.get("previous_meta") or {}
+
+    if previous:
+        previous_static = posixpath.join(previous,
+                fabric.env.cfg.static_root)
+
+        if dir_exists(previous_static):
+            # An existing target would get the copy nested inside it
+            fabric.run("rm -rf {1} && cp -al {0} {1}".format(previous_static,
+                posixpath.join(fabric.env.release_dir,
+                    fabric.env.cfg.static_root)))
+
+            if (previous_meta.get("static_fingerprint") ==
+                    fabric.env.static_fingerprint):
+                return
+
     django_run("collectstatic", "--noinput", "-v 0")
 
 
 @fabric.task
+@traced
 def write_release_manifest():
-    migrations = parse_migrations(str(django_run("migrate", "--list",
-        quiet=True)))
-    manifest = get_release_manifest(migrations)
-    fabric.put(manifest, root_path("current/manifest.cfg"))
+    """Write the release manifest and the plan for rolling it back
+
+    The rollback plan targets the release this one replaces, so a later
+    rollback only has to read it instead of comparing manifests. The
+    release is also added to the host's release index.
+    """
+    manifest = get_release_manifest(get_migrations())
+
+    _, index = read_release_index()
+    index[posixpath.basename(fabric.env.release_dir)] = get_release_meta(
+            manifest.getvalue(), friendly=False)
+
+    with file_sync() as sync:
+        write_release_index(index)
+        sync.file(manifest, release_path("manifest.cfg"), compare=False)
+
+        if fabric.env.get("previous_manifest"):
+            sync.file(get_rollback_plan(manifest.getvalue(),
+                fabric.env.previous_manifest, fabric.env.previous_release),
+                release_path("rollback.cfg"), compare=False)
 
 
 @fabric.task
+@traced
+def warmup():
+    """Byte-compile the release and its virtualenv and import the app
+
+    Compilation is spread over every core. Files that don't compile (such
+    as Python 3 only modules some packages ship) are skipped rather than
+    failing the deploy, but the WSGI application must import or the
+    release is never switched to.
+    """
+    venv = release_venv()
+    python = posixpath.join(venv, "bin", "python")
+
+    fabric.run("find {} {}/lib -name '*.py' -print0 | "
+            "xargs -0 -r -n 200 -P $(nproc 2>/dev/null || echo 2) "
+            "{} -m py_compile >/dev/null 2>&1 || true".format(
+                fabric.env.release_dir, venv, python))
+
+    env = {
+        "PYTHONPATH": "{0}:{0}/{1}".format(fabric.env.release_dir,
+            fabric.env.cfg.app_name),
+        "DJANGO_SETTINGS_MODULE": "{}.settings".format(
+            fabric.env.cfg.app_name),
+    }
+
+    with fabric.shell_env(**env):
+        fabric.run("{} {} {} -c 'import {}.wsgi as wsgi; wsgi.application'"
+                .format(posixpath.join(venv, "bin", "envrun"),
+                    root_path("shared/secrets/environ.cfg"), python,
+                    fabric.env.cfg.app_name))
+
+
+@fabric.task
+@traced
 def casexpert_hack():
     template = local_path("templates/casexpert_settings.py")
-    upload_template(template,
-            root_path("current/settings_local.py"), {}, backup=False)
+
+    with file_sync() as sync:
+        sync.template(template, release_path("settings_local.py"), {})
 
     pip_run("install",
             "--find-links", "http://packages.finiteloopsoftware.com/eggs/",
             "finiteloop")
 
 
-@fabric.task(default=True)
+@fabric.task
 @requires_config
-def deploy():
-    """Run deployment
+@traced
+def start():
+    all_processes_sudo("start")
+
+
+@fabric.task
+@requires_config
+@traced
+def stop():
+    all_processes_sudo("stop")
+
+
+@fabric.task
+@requires_config
+@traced
+def restart(mode=None):
+    """Restart every process, reloading the web process gracefully if set
+
+    mode defaults to the restart_mode config key. With hup or usr2 the web
+    process's gunicorn is reloaded in place (see graceful_reload) and only
+    restarted the hard way when the reload can't be confirmed. Other
+    processes are always restarted.
+    """
+    mode = mode or fabric.env.cfg.restart_mode
+
+    for process in fabric.env.cfg.processes:
+        if process != "web" or mode == "restart":
+            process_sudo("restart", process)
+        elif not graceful_reload(mode, fabric.env.cfg.reload_timeout):
+            print colors.yellow("Graceful reload failed on {}, "
+                    "restarting".format(fabric.env.host_string))
+            process_sudo("restart", process)
+
+
+# Everything up to link_release works on the release directory, the live
+# release is untouched until the new one is complete and warmed up
+DEPLOY_PIPELINE = Pipeline()
+DEPLOY_PIPELINE.add(setup_host)
+DEPLOY_PIPELINE.add(update_code, requires=[setup_host])
+DEPLOY_PIPELINE.add(upload_wheels, requires=[setup_host])
+DEPLOY_PIPELINE.add(pip_install_requirements,
+        requires=[update_code, upload_wheels])
+DEPLOY_PIPELINE.add(casexpert_hack, requires=[pip_install_requirements])
+DEPLOY_PIPELINE.add(precompile_assets, requires=[casexpert_hack])
+DEPLOY_PIPELINE.add(build_docs, requires=[casexpert_hack])
+DEPLOY_PIPELINE.add(warmup, requires=[casexpert_hack])
+DEPLOY_PIPELINE.add(migrate, requires=[casexpert_hack])
+DEPLOY_PIPELINE.add(write_release_manifest,
+        requires=[migrate, precompile_assets])
+DEPLOY_PIPELINE.add(link_release,
+        requires=[write_release_manifest, warmup, build_docs])
+DEPLOY_PIPELINE.add(restart, requires=[link_release])
+
+
+@traced
+def deploy_host():
+    """Run the whole deployment pipeline against the current host only
+
+    Independent steps run concurrently unless concurrent_steps is off.
+    Commands always abort on failure here, even when the caller runs the
+    pipeline with warn_only set to collect per-host results. State the
+    steps share through env, such as the migration list, is scoped to the
+    host so a serial deploy never reuses another host's. Returns the
+    host's connection counters.
+    """
+    with fabric.settings(warn_only=False, migrations=None,
+            migration_timings=[], static_fingerprint=None):
+        timings = DEPLOY_PIPELINE.run(
+                concurrent=fabric.env.cfg.get_bool("concurrent_steps"))
+
+    DEPLOY_PIPELINE.print_report(timings)
+
+    return connection_stats(fabric.env.host_string)
+
+
+def prepare_release():
+    """Pin the release and pick its directory, distributing it if configured
+
+    The ref is resolved to one SHA locally, before any host is touched, so
+    every host and every batch of a rolling deploy gets the same commit.
+    With release_artifacts enabled the release is built once into a cached
+    artifact that every host unpacks. Otherwise wheels are built locally
+    when local_wheels is on and, with release_distribution set to fanout,
+    the release is fetched from origin once and spread between the hosts
+    before any host deploys.
     """
     fabric.env.release_dir = get_release_dir()
+    fabric.env.pinned_release = ref, sha = resolve_release()
 
-    fabric.execute('setup.setup')
+    print colors.yellow("Deploying {} ({})".format(ref, sha[:12]))
 
-    fabric.execute(update_code)
-    fabric.execute(link_release)
-    fabric.execute(pip_install_requirements)
-    fabric.execute(casexpert_hack)
-    fabric.execute(precompile_assets)
-    fabric.execute(build_docs)
-    fabric.execute(migrate)
-    fabric.execute(write_release_manifest)
+    if fabric.env.cfg.get_bool("release_artifacts"):
+        fabric.env.release_artifact = build_artifact()
+        return
 
-    fabric.execute(restart)
+    if fabric.env.cfg.get_bool("local_wheels"):
+        fabric.env.local_wheels = local_wheelhouse(sha)
 
+    if fabric.env.cfg.release_distribution == "fanout":
+        fabric.env.distributed_release = distribute_release(fabric.env.hosts,
+                fabric.env.cfg.fanout_width, ref, sha)
 
-@fabric.task
-@requires_config
-def start():
-    all_processes_sudo("start")
 
+def check_rolling_gate():
+    """Run the configured rolling gate command on the current host
+    """
+    return test_cmd(fabric.env.cfg.rolling_gate)
 
-@fabric.task
+
+@fabric.task(default=True)
+@fabric.runs_once
 @requires_config
-def stop():
-    all_processes_sudo("stop")
+@traced
+def deploy():
+    """Run deployment
+    """
+    prepare_release()
+
+    fabric.execute(deploy_host)
+
+    print_connection_stats()
 
 
 @fabric.task
+@fabric.runs_once
 @requires_config
-def restart():
-    all_processes_sudo("restart")
+@traced
+def rolling_deploy(batch_size=None):
+    """Deploy to hosts in parallel batches, halting on the first bad batch
+
+    batch_size is a host count or a percentage of hosts (eg. 25%) and
+    defaults to the rolling_batch_size config key. A batch passes its gate
+    when every host finished the pipeline and, if configured, the
+    rolling_gate command succeeds on each of them. The database is shared,
+    so the first host deploys on its own and runs the migrations, every
+    other host skips migrate.
+    """
+    batch_size = batch_size or fabric.env.cfg.rolling_batch_size
+    batches = split_batches(fabric.env.hosts, batch_size)
+    prepare_release()
+
+    summary = OrderedDict((host, ("skipped", None, None)) for host in
+            fabric.env.hosts)
+    migrated = False
+
+    for number, batch in enumerate(batches, 1):
+        print colors.yellow("Deploying batch {}/{}: {}".format(
+            number, len(batches), ", ".join(batch)))
+
+        results = {}
+
+        with fabric.settings(warn_only=True):
+            if not migrated:
+                results = fabric.execute(deploy_host, hosts=batch[:1])
+                migrated = isinstance(results[batch[0]], dict)
+
+            rest = [host for host in batch if host not in results]
+
+            if migrated and rest:
+                with fabric.settings(parallel=True, pool_size=len(rest),
+                        skip_migrate=True):
+                    results.update(fabric.execute(deploy_host, hosts=rest))
+
+            passed = [host for host in batch
+                    if isinstance(results.get(host), dict)]
+
+            if passed and fabric.env.cfg.rolling_gate:
+                with fabric.settings(parallel=True, pool_size=len(passed)):
+                    gates = fabric.execute(check_rolling_gate, hosts=passed)
+            else:
+                gates = {}
+
+        for host in batch:
+            stats = results[host] if host in passed else None
+
+            if host not in results:
+                continue
+            elif host not in passed:
+                summary[host] = ("failed", number, stats)
+            elif gates.get(host, True) is not True:
+                summary[host] = ("gate failed", number, stats)
+            else:
+                summary[host] = ("ok", number, stats)
+
+        if any(summary[host][0] != "ok" for host in batch):
+            print colors.red("Batch {} did not pass the gate, halting "
+                    "rollout".format(number))
+            break
+
+    print "=" * 80
+    print_center("ROLLING DEPLOY SUMMARY")
+    print "=" * 80
+
+    for host, (status, number, stats) in summary.items():
+        color = colors.green if status == "ok" else colors.red
+        print "{:<36} {:>10} {:>16}".format(host,
+                "batch {}".format(number) if number else "-",
+                "{opened}/{reused} conn".format(**stats) if stats else "-"),
+        print color("{:>14}".format(status))
+
+    print "=" * 80
+
+    if any(status != "ok" for status, _, _ in summary.values()):
+        fabric.abort(colors.red("Rolling deploy did not reach every host"))
 
 
 @fabric.task
 @requires_config
+@traced
 def promote(from_env):
     """Promote a release from one environment to the next
     """
@@ -158,61 +732,200 @@ def promote(from_env):
 
 @fabric.task
 @requires_config
+@traced
 def prune(to_keep=5):
     """Remove old releases
+
+    Keeps the newest to_keep finished releases along with current and the
+    rollback target (see prunable_releases). The rest are moved into
+    releases/.trash at once and deleted in the background at idle I/O
+    priority, so the task doesn't wait on large trees. They are dropped
+    from the release index too. Reports the disk space they free, counting
+    only files with no other hardlinks, so only the pruned trees are
+    walked.
     """
+    current, releases = list_releases()
+    victims = prunable_releases(releases, current, int(to_keep))
+
+    if not victims:
+        print colors.green("Nothing to prune on {}".format(
+            fabric.env.host_string))
+        return 0
+
+    trash = posixpath.join(".trash", str(int(time.time())))
+
     with fabric.cd(root_path("releases")):
-        fabric.run("ls -t | tail -n $(( `ls -t | wc -l` - 5 )) | xargs rm -r")
+        fabric.run("mkdir -p {0} && mv {1} {0}/".format(trash,
+            " ".join(victims)))
+
+        # Files with other links are still used by kept releases, those
+        # only linked between pruned releases are left out as well
+        reclaimed = int(str(fabric.run("find {} -type f -links 1 "
+            "-printf '%k\\n' | awk '{{s += $1}} END {{print s + 0}}'".format(
+                trash), quiet=True)).strip() or 0) * 1024
+
+        fabric.run("nohup nice -n 19 $(command -v ionice >/dev/null && "
+                "echo ionice -c 3) rm -rf {} >/dev/null 2>&1 &".format(trash),
+                pty=False)
+
+    _, index = read_release_index()
+    write_release_index(dict((name, meta) for name, meta in index.items()
+        if name not in victims))
+
+    print colors.green("Pruned {} releases on {}, reclaiming {}".format(
+        len(victims), fabric.env.host_string, format_bytes(reclaimed)))
+
+    return reclaimed
 
 
 @fabric.task
 @requires_config
+@traced
 def print_rollback_options():
-    """List release directory and print rollback options
+    """List the host's releases from its index as rollback options
     """
+    current, index = read_release_index()
+    prior = get_prior_release(current, index)
+
     print colors.red("No rollback release specified. Options are:")
-    res = fabric.run("ls {} | sort -n".format(root_path("releases")),
+    print colors.yellow(" * previous{}".format(" ({})".format(prior)
+        if prior else ""))
+
+    for name in sorted(index, reverse=True):
+        meta = index[name]
+        print colors.yellow(" * {} {} {:<20} {}{}".format(name,
+            meta["sha"][:12], meta["ref"], release_date(meta),
+            " (current)" if name == current else ""))
+
+
+def prepare_rollback(to):
+    """Load or work out the rollback plan and run its reverse migrations
+
+    Rolling back to "previous" uses the plan stored with the current
+    release. For any other release the plan is only used if it targets
+    that release, otherwise it is worked out from both manifests. The
+    migrations run from the current release, which still has the code to
+    reverse them. Returns the name of the release to switch to.
+    """
+    current = get_current_release()
+
+    if not current:
+        fabric.abort(colors.red("Nothing is deployed, can't roll back"))
+
+    plan = fabric.run("cat {}/rollback.cfg".format(current), warn_only=True,
             quiet=True)
+    release, migrations = None, []
+
+    if plan.succeeded:
+        release, migrations = load_rollback_plan(str(plan))
+    elif to == "previous":
+        fabric.abort(colors.red("No rollback plan in {}".format(current)))
+
+    if to != "previous" and release != to:
+        release = to
+        target = get_remote_manifest(root_path("releases", to))
+        manifest = get_remote_manifest(current)
 
-    options = ["previous"]
-    options.extend(res.split("\r\n"))
-    print colors.yellow("\n".join(" * {}".format(i) for i in options))
+        if not target or not manifest:
+            fabric.abort(colors.red("Missing manifest for {} or {}".format(
+                current, to)))
+
+        migrations = list(MigrationRollback(manifest, target))
+
+    for app, version in migrations:
+        django_run("migrate", app, version)
+
+    return release
+
+
+@traced
+def rollback_host(release):
+    link_release(root_path("releases", release))
+    restart()
 
 
 @fabric.task
+@fabric.runs_once
 @requires_config
+@traced
 def rollback(to=None):
     """Rollback to a previous release
+
+    to is "previous" or the name of a release directory. Reverse
+    migrations run once, on the first host, then every host switches to
+    the release and restarts in parallel.
     """
     if not to:
         return fabric.execute(print_rollback_options)
 
-    fabric.execute(link_release, root_path("releases", to))
+    first = fabric.env.hosts[0]
+    release = fabric.execute(prepare_rollback, to, hosts=[first])[first]
 
-    # TODO: Load current and prior from release config
-    for app, version in MigrationRollback(current, prior):
-        django_run("migrate", app, version)
+    print colors.yellow("Rolling back to {}".format(release))
 
-    fabric.execute(restart)
+    with fabric.settings(parallel=True, pool_size=len(fabric.env.hosts)):
+        fabric.execute(rollback_host, release)
+
+
+@traced
+def release_status():
+    current, index = read_release_index()
+    return current, index.get(current), get_prior_release(current, index)
 
 
 @fabric.task
+@fabric.runs_once
 @requires_config
+@traced
 def info():
-    """See what's currently deployed
+    """See what's currently deployed on every host
+
+    Every host's release index is read in parallel, one round trip each.
+    Hosts running a different SHA than most of the fleet are reported as
+    drifted.
     """
-    value = fabric.run("cat {}".format(root_path("current/manifest.cfg")),
-            quiet=True)
-    data = get_release_meta(str(value))
+    hosts = fabric.env.hosts
+
+    with fabric.settings(parallel=True, pool_size=len(hosts)):
+        status = fabric.execute(release_status)
+
+    deployed = [(meta["sha"], current) for current, meta, _ in status.values()
+            if meta]
+    shas = [sha for sha, _ in deployed]
+
+    # The most common SHA, the newest release of them on a tie
+    expected = max(deployed, key=lambda (sha, current): (shas.count(sha),
+        current))[0] if deployed else None
+    width = max(len(host) for host in hosts)
 
     print "=" * 80
-    print_center("{} RELEASE MANIFEST", data["app"])
+    print_center("{} FLEET", fabric.env.cfg.app_name)
     print "=" * 80
-    print colors.yellow("released:   "), data["date"]
-    print colors.yellow("by:         "), colors.green(data["by"])
-    print colors.yellow("ref:        "), colors.red(data["ref"])
-    print colors.yellow("strategy:   "), data["type"]
-    print colors.yellow("sha:        "), data["sha"]
-    print colors.yellow("prior:      "), friendly_release_dir(
-            get_prior_release())
+
+    for host in hosts:
+        current, meta, prior = status[host]
+        meta = meta or {}
+
+        line = "{}  {:<14}  {:<12}  {:<20}  {}".format(host.ljust(width),
+            current or "-", meta.get("sha", "-")[:12], meta.get("ref", "-"),
+            meta.get("by", "-"))
+        print colors.green(line) if meta.get("sha") == expected \
+                else colors.red(line)
+        print " " * width, colors.yellow("released:"), release_date(meta), \
+                colors.yellow("prior:"), friendly_release_dir(prior) \
+                if prior else "-"
+
     print "=" * 80
+
+    drifted = [host for host in hosts
+            if (status[host][1] or {}).get("sha") != expected]
+
+    if not expected:
+        print colors.red("Nothing is deployed")
+    elif drifted:
+        print colors.red("{} of {} hosts drifted from {}: {}".format(
+            len(drifted), len(hosts), (expected or "-")[:12],
+            ", ".join(drifted)))
+    else:
+        print colors.green("All {} hosts on {}".format(len(hosts),
+            expected[:12]))
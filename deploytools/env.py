@@ -1,6 +1,8 @@
 import fabric.api as fabric
 
 from .utils import get_config
+from .utils.connections import install_connection_pool
+from .utils.trace import install_tracer
 
 
 __all__ = ["env"]
@@ -13,12 +15,17 @@ __all__ = ["env"]
 def env(project, env_name):
     """Set environment name and load config
     """
-    cfg = get_config(env_name, "{}.cfg".format(project))
+    cfg = get_config(env_name, "{}.cfg".format(project)).replace(
+            env_name=env_name)
 
     fabric.env.port = int(cfg.get("port", 22))
     fabric.env.cfg = cfg
-    fabric.env.cfg["env_name"] = env_name
     fabric.env.environment_name = env_name
     fabric.env.hosts = cfg.server_list
     fabric.env.user = cfg.user
     fabric.env.can_sudo = cfg.get_bool("can_sudo")
+
+    install_connection_pool()
+
+    if cfg.trace_file:
+        install_tracer(cfg.trace_file)
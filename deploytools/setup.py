@@ -1,12 +1,19 @@
 import os
+import json
+import hashlib
+
 import fabric.api as fabric
-from fabric.contrib.files import upload_template, append as append_to_file
+from fabric import colors
+from fabric.contrib import files
 
 from config import (UPSTART_RUNNER, DEFAULT_PROCESSES, DIRECTORIES,
         DIST_PACKAGES, BINSTUB_RUNNER, VIRTUALENV_CMD)
 
 from .utils import (local_path, root_path, test_cmd, dir_exists, mkdir,
         ErrorCollector, requires_config, local_config_path)
+from .utils.batch import RemoteBatch
+from .utils.sync import file_sync
+from .utils.trace import traced
 
 
 __all__ = [
@@ -16,95 +23,104 @@ __all__ = [
 
 
 @fabric.task
+@traced
 def create_directories():
     """Create initial directory layout and ensure permissions
     """
-    with fabric.cd(mkdir(fabric.env.cfg.root)):
-        for directory, mode, owner in DIRECTORIES:
-            mkdir(directory)
+    with RemoteBatch() as batch:
+        with fabric.cd(mkdir(fabric.env.cfg.root, batch)):
+            for directory, mode, owner in DIRECTORIES:
+                mkdir(directory, batch)
+
+                if mode:
+                    batch.chmod(mode, directory)
+
+                if owner:
+                    batch.chown(owner.format(**fabric.env.cfg.as_dict()),
+                            directory)
 
-            if mode:
-                fabric.run("chmod {} {}".format(mode, directory))
 
-            if owner:
-                fabric.run("chown {} {}".format(
-                    owner.format(**fabric.env.cfg.as_dict()), directory))
+def binstub_context():
+    args = {
+        "app_name": fabric.env.cfg.app_name,
+        "root": fabric.env.cfg.root,
+        "env_name": fabric.env.environment_name,
+    }
+
+    args["runner"] = BINSTUB_RUNNER.format(**args)
+    return args
 
 
 @fabric.task
 @requires_config
+@traced
 def create_binstubs():
     """Create binstub for django-admin.py
 
     Creates $ROOT/bin/run that is a shortcut to django-admin.py with
     appropriate environment setup.
     """
-    output = root_path("bin/run")
+    with file_sync() as sync:
+        sync.template(local_path("templates/run.sh"), root_path("bin/run"),
+                binstub_context(), mode=0755)
 
-    args = {
-        "app_name": fabric.env.cfg.app_name,
-        "root": fabric.env.cfg.root,
-        "env_name": fabric.env.environment_name,
-    }
 
-    args["runner"] = BINSTUB_RUNNER.format(**args)
-
-    upload_template(local_path("templates/run.sh"), output, args, backup=False)
-    fabric.run("chmod +x {}".format(output))
+def virtualenv_command(path):
+    return VIRTUALENV_CMD.format(
+        python=fabric.env.cfg.python_version,
+        pkgs_flag=("" if fabric.env.cfg.get_bool("site_packages")
+            else "--no-site-packages"),
+        path=path)
 
 
 @fabric.task
+@traced
 def create_virtualenv(recreate=False):
     """Create or recreate virtual environment
     """
-    args = {
-        "python": fabric.env.cfg.python_version,
-        "pkgs_flag": ("" if fabric.env.cfg.get_bool("site_packages")
-            else "--no-site-packages"),
-        "path": root_path("shared/system"),
-    }
-
+    path = root_path("shared/system")
     exists = dir_exists(root_path("shared/system/bin"))
 
     if exists and recreate:
-        fabric.run("rm -rf {}".format(args["path"]))
+        fabric.run("rm -rf {}".format(path))
 
     if exists and not recreate:
         return
 
-    fabric.run(VIRTUALENV_CMD.format(**args))
+    fabric.run(virtualenv_command(path))
+
+
+def nginx_context():
+    return {
+        "app_name": fabric.env.cfg.app_name,
+        "root": fabric.env.cfg.root,
+        "shared": root_path("shared"),
+        "server_name": fabric.env.cfg.server_name,
+        "env_name": fabric.env.environment_name,
+    }
 
 
 @fabric.task
+@traced
 def create_nginx_config():
     """Create nginx configuration files for HTTP and HTTPS
     """
     http_template = local_path("templates/nginx.cfg")
     https_template = local_path("templates/nginx_ssl.cfg")
 
-    args = {
-        "app_name": fabric.env.cfg.app_name,
-        "root": fabric.env.cfg.root,
-        "shared": root_path("shared"),
-        "server_name": fabric.env.cfg.server_name,
-        "env_name": fabric.env.environment_name,
-    }
+    args = nginx_context()
 
-    upload_template(http_template,
-            root_path("shared/config", "{app_name}-{env_name}".format(**args)),
-            args, backup=False)
+    with file_sync() as sync:
+        sync.template(http_template, root_path("shared/config",
+            "{app_name}-{env_name}".format(**args)), args)
 
-    upload_template(https_template,
-            root_path("shared/config",
-                "{app_name}-{env_name}-ssl".format(**args)),
-            args, backup=False)
+        sync.template(https_template, root_path("shared/config",
+            "{app_name}-{env_name}-ssl".format(**args)), args)
 
 
-@fabric.task
-def create_upstart_configs():
-    """Generate Upstart configuration files
+def upstart_contexts():
+    """Yield the template arguments for each process's upstart job
     """
-    template = local_path("templates/upstart.cfg")
     processes = fabric.env.cfg.processes or DEFAULT_PROCESSES
     workers = fabric.env.cfg.get("workers")
 
@@ -132,28 +148,41 @@ def create_upstart_configs():
                 command=base_command.format(**args)),
         })
 
-        upload_template(template,
-                root_path("shared/init",
-                    "{app_name}-{env_name}-{process_name}.conf".format(**args)),
-                args, backup=False)
+        yield dict(args)
+
+
+@fabric.task
+@traced
+def create_upstart_configs():
+    """Generate Upstart configuration files
+    """
+    template = local_path("templates/upstart.cfg")
+
+    with file_sync() as sync:
+        for args in upstart_contexts():
+            sync.template(template, root_path("shared/init",
+                "{app_name}-{env_name}-{process_name}.conf".format(**args)),
+                args)
 
 
 @fabric.task
+@traced
 def configure_ssh():
     """Disable strict host checking for GitHub
     """
-    if not test_cmd("grep 'Host github.com' ~/.ssh/config"):
-        fabric.run("echo 'Host github.com\n    StrictHostKeyChecking no' "
-                ">> ~/.ssh/config")
+    fabric.run("grep -q 'Host github.com' ~/.ssh/config || "
+            "echo 'Host github.com\n    StrictHostKeyChecking no' "
+            ">> ~/.ssh/config")
 
 
 @fabric.task
-def link_dist_packages():
+@traced
+def link_dist_packages(venv=None):
     # TODO: less of a shotgun approach
     dist_pkgs = "/usr/lib/python{}/dist-packages".format(
             fabric.env.cfg.python_version)
 
-    site_pkgs = root_path("shared/system/lib",
+    site_pkgs = os.path.join(venv or root_path("shared/system"), "lib",
             "python{}".format(fabric.env.cfg.python_version), "site-packages")
 
     args = ["-name {!r}".format(glob) for value in DIST_PACKAGES.values()
@@ -163,22 +192,122 @@ def link_dist_packages():
         dist_pkgs, " -o ".join(args), site_pkgs), warn_only=True)
 
 
+SETUP_STEPS = [
+    configure_ssh,
+    create_directories,
+    create_virtualenv,
+    link_dist_packages,
+    create_upstart_configs,
+    create_nginx_config,
+    create_binstubs,
+]
+
+SETUP_STATE_FILE = "shared/.setup_state"
+
+
+def render_template(name, context):
+    # upload_template renders with plain string interpolation
+    with open(local_path(name)) as fp:
+        return fp.read() % context
+
+
+def setup_resources():
+    """Return the desired state of each setup step on the current host
+
+    Anything a step's result depends on belongs in its entry, so a change
+    to the config, the directory layout or a template only re-runs the
+    steps it affects.
+    """
+    venv = virtualenv_command(root_path("shared/system"))
+    cfg = fabric.env.cfg.as_dict()
+
+    return {
+        "configure_ssh": "github.com",
+        "create_directories": [fabric.env.cfg.root] + [
+            (directory, mode, owner.format(**cfg) if owner else owner)
+            for directory, mode, owner in DIRECTORIES],
+        "create_virtualenv": venv,
+        "link_dist_packages": [venv, DIST_PACKAGES],
+        "create_upstart_configs": [
+            render_template("templates/upstart.cfg", args)
+            for args in upstart_contexts()],
+        "create_nginx_config": [
+            render_template("templates/nginx.cfg", nginx_context()),
+            render_template("templates/nginx_ssl.cfg", nginx_context())],
+        "create_binstubs": render_template("templates/run.sh",
+            binstub_context()),
+    }
+
+
+def setup_digests():
+    return dict((name, hashlib.sha1(json.dumps(value, sort_keys=True))
+        .hexdigest()) for name, value in setup_resources().items())
+
+
+def read_setup_state():
+    result = fabric.run("cat {}".format(root_path(SETUP_STATE_FILE)),
+            quiet=True)
+
+    if result.failed:
+        return {}
+
+    try:
+        return json.loads(result)
+    except ValueError:
+        return {}
+
+
+def write_setup_state(digests):
+    with file_sync() as sync:
+        sync.add(root_path(SETUP_STATE_FILE),
+                json.dumps(digests, indent=4, sort_keys=True))
+
+
+@traced
+def setup_host(force=False):
+    """Converge the current host to the desired setup state
+
+    The digest of every step's desired state is kept on the host after a
+    successful setup. Steps whose digest still matches are skipped, so an
+    unchanged host costs a single round trip. A virtualenv whose recorded
+    state changed (e.g. a new python_version) is rebuilt. Changes made on
+    the host by hand are not detected, use force to re-run every step.
+    """
+    desired = setup_digests()
+    current = {} if force else read_setup_state()
+
+    changed = [step for step in SETUP_STEPS
+            if current.get(step.__name__) != desired[step.__name__]]
+
+    if not changed:
+        print colors.green("Setup is up to date on {}".format(
+            fabric.env.host_string))
+        return
+
+    # Every changed template and the new state go up in one transfer
+    with file_sync():
+        for step in changed:
+            if step is create_virtualenv and step.__name__ in current:
+                step(recreate=True)
+            else:
+                step()
+
+        write_setup_state(desired)
+
+
 @fabric.task
+@fabric.runs_once
 @requires_config
-def setup():
+@traced
+def setup(force="false"):
     """Setup a new environment, no deployment
     """
-    fabric.execute(configure_ssh)
-    fabric.execute(create_directories)
-    fabric.execute(create_virtualenv)
-    fabric.execute(link_dist_packages)
-    fabric.execute(create_upstart_configs)
-    fabric.execute(create_nginx_config)
-    fabric.execute(create_binstubs)
+    fabric.execute(setup_host, force=force == "true")
 
 
 @fabric.task
 @requires_config
+@traced
 def recreate_virtualenv():
     """Purge the old virtualenv and recreate
     """
@@ -188,6 +317,7 @@ def recreate_virtualenv():
 
 @fabric.task
 @requires_config
+@traced
 def purge():
     """Completely remove all app directories
     """
@@ -201,6 +331,7 @@ def purge():
 
 @fabric.task
 @requires_config
+@traced
 def check():
     """Ensure server has all needed dependencies
     """
@@ -211,11 +342,12 @@ def check():
     error.test("which yui-compressor", "Missing `yui-compressor` executable")
     error.test("groups | grep www-data", "User not in the `www-data` group")
 
-    return error.value
+    return error.run()
 
 
 @fabric.task
 @requires_config
+@traced
 def configure_server(as_user):
     """Do one-time configuration of server
     """
@@ -231,7 +363,7 @@ def configure_server(as_user):
         if not test_cmd(group_check.format(fabric.env.cfg.user)):
             fabric.sudo("usermod -a -G www-data {}".format(fabric.env.cfg.user))
 
-        append_to_file("/etc/sudoers",
+        files.append("/etc/sudoers",
                 sudoers_template.format(**cfg_dict), use_sudo=True)
 
     fabric.execute(setup)
@@ -247,6 +379,7 @@ def configure_server(as_user):
 
 @fabric.task
 @requires_config
+@traced
 def put_secrets():
     """Push secret configs to server and set permissions
     """
@@ -255,5 +388,5 @@ def put_secrets():
         fabric.env.cfg.app_name,
         "{}.cfg".format(fabric.env.environment_name)))
 
-    fabric.put(secrets, secret_file)
-    fabric.run("chmod 600 {}".format(secret_file))
+    with file_sync() as sync:
+        sync.file(secrets, secret_file, mode=0600, secret=True)
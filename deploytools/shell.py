@@ -1,10 +1,15 @@
+import pipes
+
 import fabric.api as fabric
 
 from .utils import requires_config, root_path
+from .utils.logs import LogReader, merge_streams, open_log_stream
+from .utils.trace import traced
 
 
 @fabric.task
 @requires_config
+@traced
 def shell():
     """Start a django shell
     """
@@ -13,6 +18,7 @@ def shell():
 
 @fabric.task
 @requires_config
+@traced
 def clearsessions():
     """clear the Django sessions
     """
@@ -21,6 +27,7 @@ def clearsessions():
 
 @fabric.task
 @requires_config
+@traced
 def invalidate():
     """Invalidate the caches
     """
@@ -30,8 +37,37 @@ def invalidate():
 
 
 @fabric.task
+@fabric.runs_once
 @requires_config
-def tail_log():
-    """Tail application log
+@traced
+def tail_log(log="error.log", grep=None, lines=10, window=1):
+    """Tail application log on every host at once
+
+    Lines are merged by their timestamp and prefixed with their host. grep
+    is an extended regex applied on the hosts, so only matching lines are
+    sent back.
     """
-    pass
+    command = "tail -n {} -F {}".format(int(lines),
+            pipes.quote(root_path("shared/log", log)))
+
+    if grep:
+        command += " | grep --line-buffered -E -e {}".format(pipes.quote(grep))
+
+    channels, readers = [], []
+
+    try:
+        # Connecting may prompt, so it happens here before any thread starts
+        for host in fabric.env.cfg.server_list:
+            channel, stream = open_log_stream(host, command)
+            channels.append(channel)
+            readers.append(LogReader(host, stream))
+
+        for reader in readers:
+            reader.start()
+
+        merge_streams(readers, window=float(window))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for channel in channels:
+            channel.close()
@@ -1,7 +1,11 @@
 #!/bin/bash
 
-export PYTHONPATH="%(root)s/current:%(root)s/current/%(app_name)s"
-export PATH="%(root)s/shared/system/bin:%(root)s/bin:%(root)s:/usr/bin:/bin"
+# RELEASE and VENV let deploys run against a release before it is current
+RELEASE="${RELEASE:-%(root)s/current}"
+VENV="${VENV:-%(root)s/shared/system}"
+
+export PYTHONPATH="$RELEASE:$RELEASE/%(app_name)s"
+export PATH="$VENV/bin:%(root)s/bin:%(root)s:/usr/bin:/bin"
 
 COMMAND="$1"
 shift
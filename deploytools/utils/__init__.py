@@ -1,4 +1,10 @@
 import os
+import re
+import math
+import errno
+import hashlib
+import cPickle as pickle
+from string import Formatter
 from functools import wraps
 from datetime import datetime
 from ConfigParser import SafeConfigParser, NoSectionError
@@ -6,8 +12,22 @@ from ConfigParser import SafeConfigParser, NoSectionError
 import fabric.api as fabric
 from fabric import colors
 
+from .batch import RemoteBatch
+
+
+class ConfigError(Exception):
+    pass
+
 
 class AttrDict(dict):
+    """Compiled, read-only project configuration
+
+    Every value is resolved once when the config is built: {key}
+    references are interpolated in dependency order (a reference cycle is
+    an error instead of endless recursion), defaults are filled in and
+    *_list values are split. Use replace() to get a copy with some keys
+    changed.
+    """
 
     DEFAULTS = {
         "skip_syncdb": "false",
@@ -18,65 +38,183 @@ class AttrDict(dict):
         "workers": None,
         "checkout_strategy": "deploy_branch:origin/master",
         "root": "/home/{user}",
+        "rolling_batch_size": "25%",
+        "rolling_gate": None,
+        "keepalive": "30",
+        "incremental_releases": "false",
+        "release_copy_mode": "hardlink",
+        "keyed_virtualenvs": "false",
+        "incremental_static": "false",
+        "static_root": "serve_static",
+        "concurrent_steps": "true",
+        "trace_file": None,
+        "release_distribution": "origin",
+        "fanout_width": "2",
+        "release_artifacts": "false",
+        "artifact_builder": None,
+        "artifact_cache": "~/.cache/deploytools/artifacts",
+        "local_wheels": "false",
+        "wheel_cache": "~/.cache/deploytools/wheels",
+        "wheel_python": "python{python_version}",
+        "restart_mode": "restart",
+        "reload_timeout": "30",
     }
 
     SENTINEL = object()
 
-    def as_dict(self):
-        # This is a hack around doing ** expansion for kwargs since I'm not
-        # sure what to do to override that.
-        return dict((k, self.get(k)) for k in self.keys())
+    def __init__(self, *args, **kwargs):
+        raw = dict(*args, **kwargs)
+        dict.__init__(self, self.compile(raw))
+        self.__dict__["raw"] = raw
+
+    @classmethod
+    def compiled(cls, raw, values):
+        """Rebuild a config from already compiled values
+        """
+        cfg = dict.__new__(cls)
+        dict.__init__(cfg, values)
+        cfg.__dict__["raw"] = raw
+        return cfg
+
+    @classmethod
+    def compile(cls, raw):
+        values = dict(cls.DEFAULTS)
+        values.update(raw)
+
+        compiled, visiting = {}, []
+
+        def resolve(key):
+            if key in compiled:
+                return compiled[key]
+
+            if key not in values:
+                raise ConfigError("Config key {!r} referenced by {!r} is "
+                        "not set".format(key, visiting[-1]))
+
+            if key in visiting:
+                cycle = visiting[visiting.index(key):] + [key]
+                raise ConfigError("Config reference cycle: {}".format(
+                    " -> ".join(cycle)))
+
+            visiting.append(key)
+            value = values[key]
+
+            if hasattr(value, "format"):
+                value = value.format(**dict((name, resolve(name))
+                    for name in cls.references(value)))
+
+            if key.endswith("_list") and value is not None:
+                value = [i.strip() for i in value.split(",")]
+
+            visiting.pop()
+            compiled[key] = value
+            return value
+
+        for key in values:
+            resolve(key)
+
+        return compiled
+
+    @staticmethod
+    def references(value):
+        names = set()
+
+        for _, field, _, _ in Formatter().parse(value):
+            if field:
+                names.add(re.split(r"[.\[]", field, 1)[0])
+
+        return names
+
+    def replace(self, **overrides):
+        raw = dict(self.raw)
+        raw.update(overrides)
+        return self.__class__(raw)
 
-    def items(self):
-        return [(k, self.get(k)) for k in self.keys()]
+    def as_dict(self):
+        return dict(self)
 
     def get_bool(self, key, default=SENTINEL):
         return self.get(key, default).lower() == "true"
 
     def get(self, attr, default=SENTINEL):
-        value = dict.get(self, attr, default)
-
-        if value is self.SENTINEL:
-            value = self.DEFAULTS[attr]
+        if dict.__contains__(self, attr):
+            return dict.__getitem__(self, attr)
 
-        if hasattr(value, "format"):
-            value = value.format(**self)
+        if default is self.SENTINEL:
+            raise KeyError(attr)
 
-        if attr.endswith("_list"):
-            return [i.strip() for i in value.split(",")]
+        if hasattr(default, "format"):
+            return default.format(**self)
 
-        return value
+        return default
 
     __getitem__ = get
-    __getattr__ = get
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+
+        return self.get(attr)
 
     def __iter__(self):
         for key in self.keys():
             yield self.get(key)
 
+    def __reduce__(self):
+        return (_compiled_config, (self.__class__, self.raw, dict(self)))
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Config is read-only, use replace() instead")
+
+    __setitem__ = __delitem__ = __setattr__ = _immutable
+    update = setdefault = pop = popitem = clear = _immutable
+
+
+def _compiled_config(cls, raw, values):
+    return cls.compiled(raw, values)
+
 
 class ErrorCollector(object):
+    """Collect dependency checks and run them in a single round trip
+    """
 
     def __init__(self):
         self.value = 0
+        self.batch = RemoteBatch()
+        self.checks = []
 
     def test(self, cmd, if_missing):
-        if not test_cmd(cmd):
-            print(colors.red(if_missing))
-            self.value = 0
+        self.checks.append((test_cmd(cmd, batch=self.batch), if_missing))
+
+    def run(self):
+        self.batch.run()
+
+        for result, if_missing in self.checks:
+            if result.failed:
+                print(colors.red(if_missing))
+                self.value = 1
 
+        return self.value
+
+
+def test_cmd(cmd, batch=None):
+    if batch is not None:
+        return batch.test(cmd)
 
-def test_cmd(cmd):
     return fabric.run(cmd, warn_only=True, quiet=True).succeeded
 
 
-def mkdir(path):
-    fabric.run("test -d {path} || mkdir -p {path}".format(path=path))
+def mkdir(path, batch=None):
+    if batch is not None:
+        batch.mkdir(path)
+    else:
+        fabric.run("test -d {path} || mkdir -p {path}".format(path=path))
+
     return path
 
 
-def dir_exists(path):
-    return test_cmd("test -d {}".format(path))
+def dir_exists(path, batch=None):
+    return test_cmd("test -d {}".format(path), batch=batch)
 
 
 def requires_config(func):
@@ -104,10 +242,21 @@ def local_config_path(filename):
         raise Exception("No config file found - {}".format(filename))
 
 
-def get_config(env_name, filename="project.cfg"):
+_configs = {}
+
+
+def config_cache_path(path, env_name):
+    key = hashlib.sha1(repr((os.path.abspath(path), env_name,
+        sorted(AttrDict.DEFAULTS.items())))).hexdigest()
+
+    return os.path.join(os.getenv("DEPLOY_CONFIG_CACHE",
+        os.path.join(os.getenv("HOME", ""), ".cache", "deploytools")), key)
+
+
+def read_config(path, env_name):
     cfg = SafeConfigParser()
-    cfg.read(local_config_path(filename))
-    app_cfg = AttrDict(cfg.items("ALL_ENVIRONMENTS"))
+    cfg.read(path)
+    app_cfg = dict(cfg.items("ALL_ENVIRONMENTS"))
 
     try:
         app_cfg.update(cfg.items(env_name))
@@ -122,27 +271,77 @@ def get_config(env_name, filename="project.cfg"):
     return app_cfg
 
 
+def get_config(env_name, filename="project.cfg"):
+    """Load and compile the config for an environment
+
+    Compiled configs are memoized and cached on disk, and reused for as
+    long as the config file's mtime and size stay the same.
+    """
+    path = local_config_path(filename)
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+    cache = config_cache_path(path, env_name)
+
+    if _configs.get(cache, (None,))[0] == version:
+        return _configs[cache][1]
+
+    cfg = _load_config(path, env_name, version, cache)
+    _configs[cache] = (version, cfg)
+    return cfg
+
+
+def _load_config(path, env_name, version, cache):
+    try:
+        with open(cache, "rb") as fp:
+            cached_version, cfg = pickle.load(fp)
+
+        if cached_version == version:
+            return cfg
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    cfg = AttrDict(read_config(path, env_name))
+
+    try:
+        os.makedirs(os.path.dirname(cache))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return cfg
+
+    try:
+        with open(cache + ".tmp", "wb") as fp:
+            pickle.dump((version, cfg), fp, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(cache + ".tmp", cache)
+    except (IOError, OSError):
+        pass
+
+    return cfg
+
+
+def process_sudo(cmd, process):
+    fabric.sudo("/sbin/{} {}-{}".format(cmd, fabric.env.cfg.app_name,
+        process))
+
 
 def all_processes_sudo(cmd):
     for process in fabric.env.cfg.processes:
-        fabric.sudo("/sbin/{} {}-{}".format(cmd, fabric.env.cfg.app_name,
-            process))
-
+        process_sudo(cmd, process)
 
-def get_release_ref():
-    method, name = fabric.env.cfg.checkout_strategy.split(":", 1)
 
-    if method not in ("deploy_tag", "deploy_branch", "deploy_rev"):
-        raise Exception("Invalid deployment strategy {!r}".format(method))
+def split_batches(hosts, size):
+    """Split hosts into batches of `size` hosts or `size` percent of hosts
+    """
+    size = str(size).strip()
 
-    if method == "deploy_tag":
-        name = fabric.run("git tag -l '{}-*' | sort -nr | head -n1".format(
-            name))
+    if size.endswith("%"):
+        count = int(math.ceil(len(hosts) * float(size[:-1]) / 100))
+    else:
+        count = int(size)
 
-    if not name.strip():
-        raise Exception("No valid rev was found for {!r}".format(name))
+    count = max(1, count)
+    return [hosts[i:i + count] for i in range(0, len(hosts), count)]
 
-    return name
 
 def get_release_dir():
     return os.path.join(fabric.env.cfg.root, "releases",
@@ -157,15 +356,50 @@ def friendly_release_dir(name):
     return friendly_date(name, "%Y%m%d%H%M%S")
 
 
+def release_path(*args):
+    """Path inside the release being deployed, or current outside a deploy
+    """
+    return _rooted_path(fabric.env.get("release_dir") or root_path("current"),
+            *args)
+
+
+def release_venv():
+    """Return the virtualenv the release being deployed runs in
+    """
+    release = fabric.env.get("release_dir")
+
+    if release and fabric.env.cfg.get_bool("keyed_virtualenvs"):
+        return os.path.join(release, ".venv")
+
+    return root_path("shared/system")
+
+
+def django_env():
+    """Environment that points bin/run at the release being deployed
+
+    Outside of a deploy that is whatever current points at.
+    """
+    env = {"VENV": release_venv()}
+
+    if fabric.env.get("release_dir"):
+        env["RELEASE"] = fabric.env.release_dir
+
+    return env
+
+
 def django_run(cmd, *args, **kwargs):
     command = [root_path("bin/run"), cmd] + list(args)
-    return fabric.run(" ".join(command), **kwargs)
+
+    with fabric.shell_env(**django_env()):
+        return fabric.run(" ".join(command), **kwargs)
 
 
 def pip_run(cmd, *args, **kwargs):
+    venv = kwargs.pop("venv", None) or release_venv()
+
     env = {
         "PIP_DOWNLOAD_CACHE": root_path(".pip_cache"),
-        "PATH": root_path("shared/system/bin"),
+        "PATH": os.path.join(venv, "bin"),
     }
 
     with fabric.shell_env(**env), fabric.cd(fabric.env.release_dir):
@@ -173,15 +407,36 @@ def pip_run(cmd, *args, **kwargs):
         return fabric.run(" ".join(cmd))
 
 
+def switch_symlink(target, link):
+    """Atomically point link at target, replacing any existing symlink
+    """
+    fabric.run("ln -sfn {target} {link}.$$ && mv -Tf {link}.$$ {link}"
+            .format(target=target, link=link))
+
+
+def format_bytes(value):
+    for unit in ("B", "K", "M"):
+        if value < 1024:
+            return "{:.0f}{}".format(value, unit)
+
+        value /= 1024.0
+
+    return "{:.1f}G".format(value)
+
+
 def print_center(string, *args):
     l = len(string)
     left = 80 / 2 - l + 1
     print " " * left, string.format(*args).upper()
 
 
-def get_prior_release():
-    with fabric.cd(os.path.join(fabric.env.cfg.root, "releases")):
-        return fabric.run("ls -t | head -n 2 | tail -n 1", quiet=True)
+def get_current_release():
+    """Return the release directory current points at, None if unset
+    """
+    release = fabric.run("readlink {}".format(root_path("current")),
+            warn_only=True, quiet=True)
+
+    return str(release).strip() if release.succeeded else None
 
 
 def _rooted_path(root, *args):
@@ -0,0 +1,139 @@
+import uuid
+
+import fabric.api as fabric
+from fabric import colors
+
+
+class BatchResult(object):
+    """Outcome of a single queued operation
+
+    Filled in once the batch it belongs to has run. Mirrors the parts of
+    fabric's run result that tasks rely on.
+    """
+
+    def __init__(self, command, check=True):
+        self.command = command
+        self.check = check
+        self.return_code = None
+        self.stdout = ""
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+    def __str__(self):
+        return self.stdout
+
+
+class RemoteBatch(object):
+    """Queue small remote operations and run them in one round trip
+
+    Every operation runs in its own subshell, from the working directory
+    that was active when it was queued, so one failing operation doesn't
+    stop the rest. Output and exit status come back per operation. Failed
+    operations queued with check=True abort the task unless warn_only is
+    set. Used as a context manager the batch runs on exit.
+    """
+
+    def __init__(self, use_sudo=False):
+        self.use_sudo = use_sudo
+        self.results = []
+        self.marker = "__batch_{}__".format(uuid.uuid4().hex)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def add(self, command, check=True):
+        if fabric.env.cwd:
+            command = "cd {} && ({})".format(fabric.env.cwd, command)
+
+        result = BatchResult(command, check)
+        self.results.append(result)
+        return result
+
+    def mkdir(self, path):
+        return self.add("test -d {path} || mkdir -p {path}".format(path=path))
+
+    def chmod(self, mode, path):
+        return self.add("chmod {} {}".format(mode, path))
+
+    def chown(self, owner, path):
+        return self.add("chown {} {}".format(owner, path))
+
+    def test(self, cmd):
+        return self.add(cmd, check=False)
+
+    def dir_exists(self, path):
+        return self.test("test -d {}".format(path))
+
+    def file_exists(self, path):
+        return self.test("test -f {}".format(path))
+
+    def script(self):
+        # The end marker starts on a new line even when the output doesn't
+        # end with one, parse drops the blank line that adds otherwise
+        return "; ".join(
+            "echo {marker} {index}; ( {command} ) 2>&1; "
+            "printf '\\n{marker} {index} %s\\n' $?".format(marker=self.marker,
+                index=index, command=result.command)
+            for index, result in enumerate(self.results)
+            if result.return_code is None)
+
+    def parse(self, output):
+        current, lines = None, []
+
+        for line in output.splitlines():
+            parts = line.split()
+
+            if not parts or parts[0] != self.marker:
+                if current is not None:
+                    lines.append(line)
+            elif len(parts) == 2:
+                current, lines = int(parts[1]), []
+            else:
+                if lines and not lines[-1].strip():
+                    lines.pop()
+
+                result = self.results[int(parts[1])]
+                result.return_code = int(parts[2])
+                result.stdout = "\n".join(lines)
+                current = None
+
+    def run(self):
+        pending = [r for r in self.results if r.return_code is None]
+
+        if not pending:
+            return self.results
+
+        runner = fabric.sudo if self.use_sudo else fabric.run
+
+        with fabric.settings(cwd=""):
+            output = runner(self.script(), quiet=True, warn_only=True)
+
+        self.parse(output)
+
+        # Anything left unset never ran, usually the connection went away
+        for result in pending:
+            if result.return_code is None:
+                result.return_code = -1
+
+        failed = [r for r in pending if r.check and r.failed]
+
+        for result in failed:
+            message = "Batched command failed ({}): {}".format(
+                result.return_code, result.command)
+
+            if fabric.env.warn_only:
+                fabric.warn(message)
+            else:
+                fabric.abort(colors.red(message))
+
+        return self.results
@@ -0,0 +1,107 @@
+from collections import defaultdict
+
+import fabric.api as fabric
+from fabric import colors, state
+from fabric.network import HostConnectionCache, normalize_to_string
+
+
+class ConnectionPool(HostConnectionCache):
+    """Fabric connection cache that keeps one live connection per host
+
+    Fabric already caches a client per host string, which every run, sudo
+    and SFTP transfer shares as channels of the same transport. This adds
+    a liveness check so a dropped connection is transparently reopened
+    instead of failing the next command, and counts how many connections
+    were opened and how many requests reused an existing one.
+    """
+
+    def connect(self, key):
+        key = normalize_to_string(key)
+        stats = self.stats[key]
+
+        if dict.__contains__(self, key):
+            stats["reconnected"] += 1
+        else:
+            stats["opened"] += 1
+
+        return HostConnectionCache.connect(self, key)
+
+    def __getitem__(self, key):
+        key = normalize_to_string(key)
+        client = dict.get(self, key)
+
+        if client is None or not self.is_alive(client):
+            if client is not None:
+                client.close()
+
+            self.connect(key)
+        else:
+            self.stats[key]["reused"] += 1
+
+        return dict.__getitem__(self, key)
+
+    @staticmethod
+    def is_alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    @property
+    def stats(self):
+        # Stored on the instance dict since the pool is installed by
+        # swapping the class of fabric's existing cache
+        if "_stats" not in self.__dict__:
+            self.__dict__["_stats"] = defaultdict(lambda: {
+                "opened": 0, "reused": 0, "reconnected": 0})
+
+        return self.__dict__["_stats"]
+
+
+def install_connection_pool():
+    """Swap fabric's shared connection cache for a ConnectionPool
+
+    fabric.operations and friends hold direct references to the cache
+    object, so the existing instance is upgraded in place.
+    """
+    state.connections.__class__ = ConnectionPool
+
+    fabric.env.eagerly_disconnect = False
+
+    if not fabric.env.keepalive:
+        fabric.env.keepalive = int(fabric.env.cfg.keepalive)
+
+
+def connection_stats(host_string=None):
+    """Return connection counters for one host or summed across all hosts
+    """
+    totals = {"opened": 0, "reused": 0, "reconnected": 0}
+
+    if not isinstance(state.connections, ConnectionPool):
+        return totals
+
+    if host_string:
+        return dict(state.connections.stats[normalize_to_string(host_string)])
+
+    for stats in state.connections.stats.values():
+        for name, value in stats.items():
+            totals[name] += value
+
+    return totals
+
+
+def merge_connection_stats(host_string, stats):
+    """Add counters reported by a forked worker to this process's pool
+    """
+    if not isinstance(state.connections, ConnectionPool):
+        return
+
+    totals = state.connections.stats[normalize_to_string(host_string)]
+
+    for name, value in stats.items():
+        totals[name] += value
+
+
+def print_connection_stats(host_string=None):
+    stats = connection_stats(host_string)
+    print colors.yellow("connections:"), (
+        "{opened} opened, {reused} reused, {reconnected} reconnected".format(
+            **stats))
@@ -0,0 +1,198 @@
+import re
+import subprocess
+
+import fabric.api as fabric
+from fabric import colors
+from fabric.network import normalize
+
+from . import root_path, dir_exists
+
+
+DEPLOY_REF = "refs/deploy/current"
+
+FULL_SHA = re.compile(r"^[0-9a-f]{40}$")
+
+
+def fanout_levels(hosts, width):
+    """Arrange hosts in a tree with `width` children per host
+
+    The first host is the seed. Returns a list of levels, each a dict of
+    host to the parent it fetches from; every level only depends on the
+    ones before it.
+    """
+    width = max(1, int(width))
+    levels, depth = [], {hosts[0]: 0}
+
+    for index, host in enumerate(hosts[1:], 1):
+        parent = hosts[(index - 1) // width]
+        depth[host] = depth[parent] + 1
+
+        while len(levels) < depth[host]:
+            levels.append({})
+
+        levels[depth[host] - 1][host] = parent
+
+    return levels
+
+
+def ensure_repo():
+    """Make sure the host has a repo to fetch releases into
+
+    It starts out empty, releases are fetched into it one commit at a time
+    (see fetch_release) rather than cloning the whole history.
+    """
+    repo_path = root_path("shared/repo")
+
+    if dir_exists(repo_path):
+        return repo_path
+
+    fabric.run("git init -q {0} && git -C {0} remote add origin {1}".format(
+        repo_path, fabric.env.cfg.repo))
+
+    return repo_path
+
+
+def ls_remote(*patterns):
+    """Return {ref: sha} for the origin refs matching patterns, locally
+
+    Annotated tags map to the commit they point at.
+    """
+    output = subprocess.check_output(["git", "ls-remote",
+        fabric.env.cfg.repo] + list(patterns))
+    refs = {}
+
+    for line in output.splitlines():
+        sha, name = line.split("\t", 1)
+
+        if name.endswith("^{}"):
+            refs[name[:-3]] = sha
+        else:
+            refs.setdefault(name, sha)
+
+    return refs
+
+
+def resolve_release():
+    """Resolve checkout_strategy to the SHA the whole fleet deploys
+
+    Resolved once on the machine running the deploy, against origin, so
+    hosts never resolve the ref themselves and can't end up on different
+    commits. deploy_tag picks the last matching tag by name. Returns the
+    ref and its SHA.
+    """
+    method, name = fabric.env.cfg.checkout_strategy.split(":", 1)
+
+    if method not in ("deploy_tag", "deploy_branch", "deploy_rev"):
+        raise Exception("Invalid deployment strategy {!r}".format(method))
+
+    if method == "deploy_rev" and FULL_SHA.match(name):
+        return name, name
+
+    if method == "deploy_tag":
+        refs = ls_remote("refs/tags/{}-*".format(name))
+        candidates = sorted(refs, reverse=True)
+    elif method == "deploy_branch":
+        branch = name[len("origin/"):] if name.startswith("origin/") \
+                else name
+        refs = ls_remote("refs/heads/{}".format(branch))
+        candidates = ["refs/heads/{}".format(branch)]
+    else:
+        refs = ls_remote(name)
+        candidates = [name, "refs/heads/{}".format(name),
+                "refs/tags/{}".format(name)]
+
+    for candidate in candidates:
+        if candidate in refs:
+            if method == "deploy_tag":
+                name = candidate[len("refs/tags/"):]
+
+            return name, refs[candidate]
+
+    raise Exception("No valid rev was found for {!r}".format(name))
+
+
+def pinned_release():
+    """Return the ref and SHA being deployed, resolving them the first time
+    """
+    if not fabric.env.get("pinned_release"):
+        fabric.env.pinned_release = resolve_release()
+
+    return fabric.env.pinned_release
+
+
+def fetch_release(sha):
+    """Fetch just the pinned commit from origin and point the deploy ref at it
+
+    The fetch is shallow and for that one SHA, so hosts only receive the
+    release's tree. Origins that don't serve unadvertised SHAs get a
+    regular fetch of every branch and tag instead, and the host fails if
+    the SHA still isn't there. Nothing is fetched if the commit is already
+    there, e.g. when redeploying.
+    """
+    with fabric.cd(ensure_repo()):
+        fabric.run("git cat-file -e {sha}^{{commit}} 2>/dev/null || "
+                "git fetch -q --no-tags --depth 1 origin {sha} || "
+                "git fetch -q origin '+refs/heads/*:refs/remotes/origin/*' "
+                "'+refs/tags/*:refs/tags/*'; "
+                "git cat-file -e {sha}^{{commit}} 2>/dev/null || "
+                "{{ echo 'Release {sha} could not be fetched from origin' >&2; "
+                "exit 1; }}; "
+                "git update-ref {ref} {sha}".format(sha=sha, ref=DEPLOY_REF))
+
+
+def seed_release(ref, sha):
+    """Fetch the pinned release from origin on this host
+
+    Returns the ref and SHA, for use with fabric.execute.
+    """
+    fetch_release(sha)
+    return ref, sha
+
+
+def peer_url(host_string):
+    user, host, port = normalize(host_string)
+    return "ssh://{}@{}:{}{}".format(user, host, port,
+            root_path("shared/repo"))
+
+
+def fetch_from_peer(parents, sha):
+    """Fetch the pinned release from this host's parent in the tree
+
+    Every received object is checked by git and the fetched ref must
+    resolve to the expected SHA, otherwise the host fails.
+    """
+    parent = parents[fabric.env.host_string]
+
+    with fabric.cd(ensure_repo()):
+        fabric.run("GIT_SSH_COMMAND='ssh -o BatchMode=yes "
+                "-o StrictHostKeyChecking=no' "
+                "git -c transfer.fsckObjects=true fetch -q {url} "
+                "+{ref}:{ref} && "
+                "test \"$(git rev-parse --verify {ref}^{{commit}})\" = {sha}"
+                .format(url=peer_url(parent), ref=DEPLOY_REF, sha=sha))
+
+
+def distribute_release(hosts, width, ref, sha):
+    """Fetch the release on the first host and fan it out to the rest
+
+    Only the seed host talks to origin. Every other host fetches from its
+    parent over ssh (with the deploying user's forwarded agent) as soon
+    as the parent's level is done, so origin serves one fetch per deploy
+    and no host serves more than `width` others. Returns the ref and SHA
+    for update_code to export.
+    """
+    seed = hosts[0]
+
+    fabric.execute(seed_release, ref, sha, hosts=[seed])
+    print colors.yellow("Seeded {} ({}) on {}".format(ref, sha[:12], seed))
+
+    for number, parents in enumerate(fanout_levels(hosts, width), 1):
+        print colors.yellow("Fan-out level {}: {}".format(number,
+            ", ".join(sorted(parents))))
+
+        with fabric.settings(parallel=True, pool_size=len(parents),
+                forward_agent=True):
+            fabric.execute(fetch_from_peer, parents, sha,
+                    hosts=list(parents))
+
+    return ref, sha
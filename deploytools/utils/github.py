@@ -1,6 +1,20 @@
 import os
+import re
 import json
-from urllib2 import urlopen, Request
+import time
+import socket
+import httplib
+import threading
+from urlparse import urlsplit
+from multiprocessing.pool import ThreadPool
+
+
+DEFAULT_API_URL = "https://api.github.com"
+
+LINK_NEXT = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+# Methods that are safe to send again when a request may have gone out
+IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE")
 
 
 def expand_path(path):
@@ -26,6 +40,14 @@ def find_github_token():
         raise IndexError("No GitHub token was found")
 
 
+class GitHubError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, "GitHub API error {}: {}".format(status,
+            message))
+        self.status = status
+
+
 class SSHKey(object):
 
     def __init__(self, filename):
@@ -37,33 +59,246 @@ class SSHKey(object):
 
         return { "title": data[-1], "key": " ".join(data[:2]) }
 
-    @property
     def __eq__(self, other):
+        if isinstance(other, SSHKey):
+            other = other.as_python()["key"]
+
         return other == self.as_python()["key"]
 
+    def __ne__(self, other):
+        return not self == other
+
     def as_json(self):
         return json.dumps(self.as_python())
 
 
-class GitHubSSHKey(object):
+class GitHubClient(object):
+    """Minimal GitHub API client for use from many threads
 
-    API_URL = "https://api.github.com/repos/{owner}/{repo}/keys"
+    Keep-alive connections to the API are pooled and shared between
+    threads. GET responses are cached by URL and revalidated with
+    If-None-Match, and 304 responses don't count against the rate limit.
+    When the limit is used up, requests wait for it to reset rather than
+    fail, for at most max_wait seconds. api_url defaults to
+    $GITHUB_API_URL or GitHub itself, so a local stand-in server can be
+    used instead.
+    """
 
-    def __init__(self, token, owner="finiteloopsoftware"):
+    def __init__(self, token, api_url=None, timeout=30, max_wait=300):
         self.token = token
+        self.api_url = (api_url or os.environ.get("GITHUB_API_URL")
+                or DEFAULT_API_URL).rstrip("/")
+        self.timeout = timeout
+        self.max_wait = max_wait
+
+        parts = urlsplit(self.api_url)
+        self.scheme, self.netloc, self.base_path = (parts.scheme,
+                parts.netloc, parts.path)
+
+        self.cache = {}
+        self.rate_limit_reset = None
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _connection(self, reuse=True):
+        with self._lock:
+            if reuse and self._idle:
+                return self._idle.pop()
+
+        factory = (httplib.HTTPSConnection if self.scheme == "https"
+                else httplib.HTTPConnection)
+        return factory(self.netloc, timeout=self.timeout)
+
+    def _url_path(self, path):
+        """Request path for an API path or a full URL from a Link header
+        """
+        if "://" in path:
+            parts = urlsplit(path)
+            return parts.path + ("?" + parts.query if parts.query else "")
+
+        return self.base_path + path
+
+    def _send(self, method, path, body, headers):
+        # A keep-alive connection the server has since closed only fails
+        # once used, so a reused one is retried once on a new connection.
+        # Other methods always get a new connection and are only retried
+        # when connecting failed, a POST the server may have received
+        # must not be sent twice
+        idempotent = method in IDEMPOTENT_METHODS
+        connection = self._connection(reuse=idempotent)
+
+        for retry in (True, False):
+            sent = False
+
+            try:
+                if connection.sock is None:
+                    connection.connect()
+
+                sent = True
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+
+                if not retry or (sent and not idempotent):
+                    raise
+
+                connection = self._connection(reuse=idempotent)
+                continue
+
+            with self._lock:
+                self._idle.append(connection)
+
+            return response, content
+
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            reset = self.rate_limit_reset
+
+        if reset and reset > time.time():
+            wait = reset - time.time()
+
+            if wait > self.max_wait:
+                raise GitHubError(403, "Rate limit exceeded until {}".format(
+                    time.ctime(reset)))
+
+            time.sleep(wait)
+
+    def _track_rate_limit(self, response):
+        remaining = response.getheader("X-RateLimit-Remaining")
+        reset = response.getheader("X-RateLimit-Reset")
+        retry_after = response.getheader("Retry-After")
+
+        with self._lock:
+            if retry_after:
+                self.rate_limit_reset = time.time() + int(retry_after)
+            elif remaining == "0" and reset:
+                self.rate_limit_reset = int(reset)
+            else:
+                self.rate_limit_reset = None
+
+    def request(self, method, path, data=None):
+        """Make an API request and return the decoded response and headers
+        """
+        path = self._url_path(path)
+        headers = {
+            "Authorization": "token {}".format(self.token),
+            "Accept": "application/vnd.github.v3+json",
+            "User-Agent": "deploytools",
+        }
+
+        with self._lock:
+            cached = self.cache.get(path) if method == "GET" else None
+
+        if cached:
+            headers["If-None-Match"] = cached[0]
+
+        body = json.dumps(data) if data is not None else None
+
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+
+        for attempt in range(2):
+            self._wait_for_rate_limit()
+            response, content = self._send(method, path, body, headers)
+            self._track_rate_limit(response)
+
+            limited = response.status in (403, 429) and (
+                    self.rate_limit_reset is not None)
+
+            if not limited:
+                break
+
+        if response.status == 304 and cached:
+            return cached[1], cached[2]
+
+        if response.status >= 400:
+            try:
+                message = json.loads(content).get("message", content)
+            except ValueError:
+                message = content
+
+            raise GitHubError(response.status, message)
+
+        value = json.loads(content) if content else None
+        received = dict(response.getheaders())
+
+        with self._lock:
+            if method == "GET" and "etag" in received:
+                self.cache[path] = (received["etag"], value, received)
+            elif method != "GET":
+                # Changes invalidate every cached page of the resource
+                for key in [key for key in self.cache
+                        if key.split("?", 1)[0] == path.split("?", 1)[0]]:
+                    del self.cache[key]
+
+        return value, received
+
+    def paginate(self, path):
+        """Yield every item of a paginated list, following Link headers
+        """
+        path = "{}{}per_page=100".format(path, "&" if "?" in path else "?")
+
+        while path:
+            items, headers = self.request("GET", path)
+
+            for item in items:
+                yield item
+
+            match = LINK_NEXT.search(headers.get("link", ""))
+            path = match.group(1) if match else None
+
+
+class GitHubSSHKey(object):
+    """Checks and adds deploy keys on an owner's repositories
+
+    The *_repos methods work on many repositories at once, workers at a
+    time, and return a dict keyed by repository.
+    """
+
+    KEYS_PATH = "/repos/{owner}/{repo}/keys"
+
+    def __init__(self, token, owner="finiteloopsoftware", api_url=None,
+            workers=8):
+        self.client = GitHubClient(token, api_url)
         self.owner = owner
+        self.workers = workers
 
-    def _make_request(self, data=None, **kwargs):
-        return urlopen(Request(self.API_URL.format(**kwargs), data,
-            { "Authorization": "token {0}".format(self.token) }))
+    def _keys_path(self, repo):
+        return self.KEYS_PATH.format(owner=self.owner, repo=repo)
 
     def add_key(self, key_file, repo):
-        return self._make_request(
-                SSHKey(key_file).as_json(), owner=self.owner, repo=repo)
+        return self.client.request("POST", self._keys_path(repo),
+                SSHKey(key_file).as_python())[0]
 
     def key_in_repo(self, key_file, repo):
-        response = self._make_request(owner=self.owner, repo=repo)
         our_key = SSHKey(key_file)
-        return any([
-            (k["key"] == our_key) for k in json.loads(response.read())
-        ])
+        return any(our_key == k["key"]
+                for k in self.client.paginate(self._keys_path(repo)))
+
+    def ensure_key(self, key_file, repo):
+        """Add the key to a repository unless it is there already
+
+        Returns whether the key had to be added.
+        """
+        if self.key_in_repo(key_file, repo):
+            return False
+
+        self.add_key(key_file, repo)
+        return True
+
+    def _map(self, func, repos):
+        pool = ThreadPool(max(1, min(self.workers, len(repos))))
+
+        try:
+            return dict(zip(repos, pool.map(func, repos)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def key_in_repos(self, key_file, repos):
+        return self._map(lambda repo: self.key_in_repo(key_file, repo), repos)
+
+    def ensure_key_in_repos(self, key_file, repos):
+        return self._map(lambda repo: self.ensure_key(key_file, repo), repos)
@@ -0,0 +1,75 @@
+import fabric.api as fabric
+
+from . import root_path
+
+
+# Exits 0 once something answers HTTP on the socket
+HEALTH_CHECK = ("{python} -c 'import socket, sys; "
+        "s = socket.socket(socket.AF_UNIX); s.settimeout(5); "
+        "s.connect(sys.argv[1]); "
+        "s.sendall(\"HEAD / HTTP/1.0\\r\\nHost: localhost\\r\\n\\r\\n\"); "
+        "sys.exit(0 if s.recv(5) == \"HTTP/\" else 1)' {socket} "
+        ">/dev/null 2>&1")
+
+# HUP makes the master start a new set of workers on the current code and
+# gracefully stop the old ones. Done once none of the old workers are left
+# and the socket answers.
+HUP_RELOAD = """
+pid=$(cat {pidfile} 2>/dev/null) && kill -0 "$pid" || exit 3
+old=" $(pgrep -P "$pid" | tr '\\n' ' ')"
+kill -HUP "$pid"
+deadline=$(( $(date +%s) + {timeout} ))
+while [ "$(date +%s)" -lt "$deadline" ]; do
+    sleep 0.5
+    fresh=0
+    stale=0
+    for worker in $(pgrep -P "$pid"); do
+        case "$old" in *" $worker "*) stale=1 ;; *) fresh=1 ;; esac
+    done
+    [ "$fresh" = 1 ] && [ "$stale" = 0 ] && {check} && exit 0
+done
+exit 4
+"""
+
+# USR2 starts a second master re-executed from scratch next to the old one.
+# The old master's workers only stop (WINCH) and it quits once the new
+# master has workers and the socket answers, otherwise the new one is
+# stopped and the old keeps serving.
+USR2_REEXEC = """
+pid=$(cat {pidfile} 2>/dev/null) && kill -0 "$pid" || exit 3
+kill -USR2 "$pid"
+deadline=$(( $(date +%s) + {timeout} ))
+while [ "$(date +%s)" -lt "$deadline" ]; do
+    sleep 0.5
+    new=$(cat {pidfile} 2>/dev/null)
+    [ -n "$new" ] && [ "$new" != "$pid" ] && kill -0 "$new" 2>/dev/null &&
+        [ -n "$(pgrep -P "$new")" ] && {check} &&
+        kill -WINCH "$pid" && kill -QUIT "$pid" && exit 0
+done
+new=$(cat {pidfile} 2>/dev/null)
+[ -n "$new" ] && [ "$new" != "$pid" ] && kill -QUIT "$new"
+exit 4
+"""
+
+
+def graceful_reload(mode="hup", timeout=30):
+    """Reload the web process's gunicorn master without dropping requests
+
+    The master is found through shared/run/gunicorn.pid and the new
+    workers are only trusted once shared/run/gunicorn.sock answers. With
+    mode usr2 the whole master is re-executed, which also picks up a
+    changed virtualenv or preloaded app, but upstart tracks the original
+    master's pid so it is only safe for jobs that expect that. Returns
+    whether the reload was confirmed.
+    """
+    script = USR2_REEXEC if mode == "usr2" else HUP_RELOAD
+
+    check = HEALTH_CHECK.format(
+            python=root_path("shared/system/bin/python"),
+            socket=root_path("shared/run/gunicorn.sock"))
+
+    result = fabric.run(script.format(pidfile=root_path(
+        "shared/run/gunicorn.pid"), timeout=int(timeout), check=check),
+        warn_only=True, quiet=True)
+
+    return result.succeeded
@@ -0,0 +1,113 @@
+import re
+import sys
+import time
+import heapq
+import threading
+from Queue import Queue, Empty
+from datetime import datetime
+
+from fabric import state
+
+
+TIMESTAMP = re.compile(r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})")
+
+# Marks the end of a host's stream in its queue
+CLOSED = object()
+
+
+def parse_timestamp(line):
+    """Return a line's leading log timestamp as epoch seconds, None if none
+    """
+    match = TIMESTAMP.search(line[:64])
+
+    if not match:
+        return None
+
+    try:
+        value = datetime.strptime(" ".join(match.groups()),
+                "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+    return time.mktime(value.timetuple())
+
+
+class LogReader(threading.Thread):
+    """Read lines from one host's stream into a bounded queue
+
+    When the queue is full the reader blocks, which stops reading from the
+    channel and lets SSH flow control hold back the remote side instead of
+    buffering a chatty host locally.
+    """
+
+    daemon = True
+
+    def __init__(self, host, stream, buffer_lines=1000):
+        threading.Thread.__init__(self, name="tail {}".format(host))
+        self.host = host
+        self.stream = stream
+        self.queue = Queue(maxsize=buffer_lines)
+        self.last_stamp = 0
+
+    def run(self):
+        try:
+            for line in iter(self.stream.readline, ""):
+                received = time.time()
+                stamp = parse_timestamp(line)
+
+                # Lines without a timestamp (tracebacks) stay with the
+                # line before them
+                if stamp is None:
+                    stamp = self.last_stamp or received
+
+                self.last_stamp = stamp
+                self.queue.put((stamp, received, line.rstrip("\r\n")))
+        finally:
+            self.queue.put(CLOSED)
+
+
+def merge_streams(readers, window=1.0, out=sys.stdout):
+    """Print lines from every reader ordered by timestamp
+
+    Keeps at most one pending line per host and prints the oldest once
+    every open host has a line pending, or once it has waited longer than
+    window seconds, so a quiet host only delays output by that much.
+    """
+    width = max(len(reader.host) for reader in readers)
+    heads, open_readers = [], set(readers)
+    pending = set()
+
+    while open_readers or heads:
+        for reader in list(open_readers - pending):
+            try:
+                item = reader.queue.get(timeout=0.01 if heads else 0.05)
+            except Empty:
+                continue
+
+            if item is CLOSED:
+                open_readers.discard(reader)
+            else:
+                heapq.heappush(heads, item[:2] + (reader.host, item[2],
+                    reader))
+                pending.add(reader)
+
+        while heads and (open_readers <= pending or
+                time.time() - heads[0][1] > window):
+            stamp, _, host, line, reader = heapq.heappop(heads)
+            pending.discard(reader)
+
+            out.write("[{}] {}\n".format(host.ljust(width), line))
+            out.flush()
+
+
+def open_log_stream(host_string, command):
+    """Run a command on a host over its own channel and return its output
+
+    The channel shares the host's cached connection, so streaming from many
+    hosts needs one thread each but no extra SSH handshakes. It gets a pty
+    so the remote command is hung up once the channel is closed.
+    """
+    channel = state.connections[host_string].get_transport().open_session()
+    channel.get_pty()
+    channel.exec_command(command)
+    return channel, channel.makefile("r")
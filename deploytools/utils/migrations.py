@@ -2,12 +2,16 @@ import socket
 import getpass
 import fabric.api as fabric
 from datetime import datetime
+from collections import OrderedDict
 from cStringIO import StringIO
 from ConfigParser import ConfigParser, SafeConfigParser
 
 from . import friendly_date
 
 
+MANIFEST_DATE = "%Y-%m-%dT%H:%M:%SZ"
+
+
 def parse_migrations(data):
     package = None
 
@@ -20,13 +24,58 @@ def parse_migrations(data):
         if not line:
             continue
         elif line.startswith("("):
-            state, name = line.split(" ", 1)
+            # Unapplied migrations are listed as "( ) name"
+            state, name = line[:3], line[3:].strip()
             installed = state == "(*)"
             yield package, name, installed
         else:
             package = line
 
 
+def migration_prefix(name):
+    """Return the numeric prefix South can target a migration by
+    """
+    return name.split("_")[0]
+
+
+def parse_migration_timings(data):
+    """Work out how long each migration took from timestamped output
+
+    Expects every line of `migrate` output prefixed with a unix timestamp
+    and a final timestamped line once the command has finished. A
+    migration runs from its `> app:name` line until the next migration
+    starts or the command ends. Returns an ordered list of
+    (app, name, seconds) tuples.
+    """
+    if not hasattr(data, "readline"):
+        data = StringIO(data)
+
+    timings = []
+    current = None
+
+    for line in data:
+        parts = line.strip().split(None, 1)
+
+        try:
+            stamp = float(parts[0])
+        except (IndexError, ValueError):
+            continue
+
+        text = parts[1].strip() if len(parts) > 1 else ""
+        is_migration = text.startswith("> ") and ":" in text
+
+        if current and (is_migration or text == "__end__"):
+            app, name, started = current
+            timings.append((app, name, round(stamp - started, 3)))
+            current = None
+
+        if is_migration:
+            app, name = text[2:].strip().split(":", 1)
+            current = app, name, stamp
+
+    return timings
+
+
 def generate_release_manifest(migrations):
     cfg = ConfigParser()
 
@@ -35,11 +84,23 @@ def generate_release_manifest(migrations):
     cfg.set("release", "app", fabric.env.cfg.app_name)
     cfg.set("release", "ref", fabric.env.deployed_ref)
     cfg.set("release", "sha", fabric.env.deployed_sha)
-    cfg.set("release", "date", datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"))
+    cfg.set("release", "date", datetime.now().strftime(MANIFEST_DATE))
     cfg.set("release", "type", fabric.env.cfg.checkout_strategy.split(":")[0])
     cfg.set("release", "by", "{}@{}".format(getpass.getuser(),
         socket.gethostname()))
 
+    if fabric.env.get("static_fingerprint"):
+        cfg.set("release", "static_fingerprint",
+                fabric.env.static_fingerprint)
+
+    for app, name, seconds in fabric.env.get("migration_timings", []):
+        sect_name = "migration_timings:{}".format(app)
+
+        if not cfg.has_section(sect_name):
+            cfg.add_section(sect_name)
+
+        cfg.set(sect_name, name, str(seconds))
+
     for app, name, is_installed in migrations:
         sect_name = "migrations:{}".format(app)
 
@@ -59,7 +120,61 @@ def get_release_manifest(migrations):
     return output
 
 
-def get_release_meta(data):
+def get_remote_manifest(release):
+    """Return the contents of a release's manifest.cfg, None if missing
+    """
+    value = fabric.run("cat {}/manifest.cfg".format(release),
+            warn_only=True, quiet=True)
+
+    return str(value) if value.succeeded else None
+
+
+def generate_rollback_plan(manifest, previous_manifest, previous_release):
+    """Work out how to roll a release back to the one deployed before it
+
+    Stores the release to switch back to and the (app, version) migrations
+    that undo the schema changes in between, see MigrationRollback. App
+    labels keep their case, load_rollback_plan reads them the same way.
+    """
+    cfg = ConfigParser()
+    cfg.optionxform = str
+
+    cfg.add_section("rollback")
+    cfg.set("rollback", "release", previous_release.rstrip("/").rsplit(
+        "/", 1)[-1])
+    cfg.set("rollback", "sha", get_release_meta(previous_manifest)["sha"])
+
+    cfg.add_section("migrations")
+
+    for app, version in MigrationRollback(manifest, previous_manifest):
+        cfg.set("migrations", app, migration_prefix(version))
+
+    return cfg
+
+
+def get_rollback_plan(manifest, previous_manifest, previous_release):
+    plan = generate_rollback_plan(manifest, previous_manifest,
+            previous_release)
+    output = StringIO()
+    plan.write(output)
+    output.seek(0)
+    return output
+
+
+def load_rollback_plan(data):
+    """Return the release name and migrations from a rollback plan
+
+    Versions are reduced to numeric prefixes, older plans stored the full
+    migration names lowercased, which South doesn't match.
+    """
+    cfg = MigrationRollback.load_cfg(data, preserve_case=True)
+    return cfg.get("rollback", "release"), [(app, migration_prefix(version))
+        for app, version in cfg.items("migrations", raw=True)]
+
+
+def get_release_meta(data, friendly=True):
+    """Return a manifest's release section, friendly=False keeps the ISO date
+    """
     if not hasattr(data, "readline"):
         data = StringIO(data)
 
@@ -67,29 +182,123 @@ def get_release_meta(data):
     cfg.readfp(data)
 
     data = dict(cfg.items("release"))
-    data["date"] = friendly_date(data["date"], "%Y-%m-%dT%H:%M:%SZ")
+
+    if friendly:
+        data["date"] = friendly_date(data["date"], MANIFEST_DATE)
 
     return data
 
 
+class MigrationState(object):
+    """Which migrations each app has, in order, and which are applied
+
+    Built from parse_migrations output or from a release manifest, which
+    lists migrations in the same order. Apps keep the order migrate --list
+    gives them.
+    """
+
+    def __init__(self, migrations=()):
+        self.apps = OrderedDict()
+        self.applied = {}
+
+        for app, name, installed in migrations:
+            self.apps.setdefault(app, []).append(name)
+            applied = self.applied.setdefault(app, set())
+
+            if installed:
+                applied.add(name)
+
+    @classmethod
+    def from_manifest(cls, manifest):
+        cfg = MigrationRollback.load_cfg(manifest)
+
+        return cls((section[11:], name, value == "true")
+                for section in cfg.sections()
+                if section.startswith("migrations:")
+                for name, value in cfg.items(section, raw=True))
+
+    def pending(self, app):
+        return [name for name in self.apps[app]
+                if name not in self.applied[app]]
+
+    def has_gaps(self, app):
+        """Whether a pending migration comes before an applied one
+        """
+        applied = [name in self.applied[app] for name in self.apps[app]]
+        return False in applied and True in applied[applied.index(False):]
+
+    def diff(self, other):
+        """Return {app: (applied here only, applied in other only)}
+
+        Apps whose applied migrations are the same in both are left out.
+        """
+        changes = {}
+
+        for app in set(self.applied) | set(other.applied):
+            ours = self.applied.get(app, set())
+            theirs = other.applied.get(app, set())
+
+            if ours != theirs:
+                changes[app] = (ours - theirs, theirs - ours)
+
+        return changes
+
+    def forward_plan(self):
+        """Return (app, target, merge) for every app with pending migrations
+
+        Each app is migrated to its last migration in one migrate call.
+        merge is set when earlier migrations are still pending behind
+        applied ones, which South only applies with --merge.
+        """
+        return [(app, names[-1], self.has_gaps(app))
+                for app, names in self.apps.items() if self.pending(app)]
+
+    def backward_plan(self, target):
+        """Return the (app, version) migrations that reach target's state
+
+        Only apps with migrations applied here that aren't in target are
+        migrated, back to the last migration target has applied or to
+        zero. Apps are undone in reverse order, so apps listed later,
+        which may depend on earlier ones, go first. Versions are numeric
+        prefixes, since manifests lowercase migration names and South
+        matches them case-sensitively.
+        """
+        plan = []
+        changes = self.diff(target)
+
+        for app in reversed(self.apps):
+            if not changes.get(app, (None,))[0]:
+                continue
+
+            kept = target.applied.get(app, set())
+            applied = [name for name in self.apps[app] if name in kept]
+            plan.append((app, migration_prefix(applied[-1])
+                if applied else "zero"))
+
+        return plan
+
+
 class MigrationRollback(object):
     """Works out a migration rollback plan
 
     Given two release manifests from the currently deployed release and the
     previously deployed release, yields a list of (app_name, version) tuples to
     be used when calling `manage.py migrate` for schema rollbacks. Handles apps
-    added between versions. Does not modify apps that have no migrations
-    between versions.
+    added between versions, which are migrated to zero. Does not modify apps
+    that have no migrations between versions. See MigrationState.
     """
 
     def __init__(self, current, prior):
-        self.current = self.load_cfg(current)
-        self.prior = self.load_cfg(prior)
+        self.current = MigrationState.from_manifest(current)
+        self.prior = MigrationState.from_manifest(prior)
 
     @staticmethod
-    def load_cfg(file):
+    def load_cfg(file, preserve_case=False):
         cfg = SafeConfigParser()
 
+        if preserve_case:
+            cfg.optionxform = str
+
         if not hasattr(file, "readline"):
             cfg.readfp(StringIO(file))
         else:
@@ -97,29 +306,5 @@ class MigrationRollback(object):
 
         return cfg
 
-    @staticmethod
-    def extract_most_recent(cfg):
-        latest = {}
-
-        for section in cfg.sections():
-            if section.startswith("migrations:"):
-                app = section[11:]
-            else:
-                continue
-
-            latest[app] = sorted([name.split("_")[0] for name in
-                cfg.options(section)], reverse=True)[0]
-
-        return latest
-
     def __iter__(self):
-        current = self.extract_most_recent(self.current)
-        prior = self.extract_most_recent(self.prior)
-
-        for app, version in current.items():
-            if app not in prior:
-                yield (app, '0000')
-                continue
-
-            if int(prior[app]) < int(version):
-                yield app, prior[app]
+        return iter(self.current.backward_plan(self.prior))
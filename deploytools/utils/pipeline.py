@@ -0,0 +1,233 @@
+import time
+import pickle
+import multiprocessing
+from Queue import Empty
+from collections import OrderedDict
+
+import fabric.api as fabric
+from fabric import colors, state
+
+from .connections import connection_stats, merge_connection_stats
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Step(object):
+
+    def __init__(self, name, func, requires):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+
+class Pipeline(object):
+    """A set of steps with explicit dependencies, run against one host
+
+    Steps whose dependencies have all finished run concurrently, each in a
+    forked process like fabric's own parallel mode. Changes a step makes to
+    fabric.env are sent back to the parent so later steps see them, which
+    means anything a step stores in env must be picklable to be shared.
+    When only one step is runnable it runs in process and keeps reusing the
+    parent's connection.
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self):
+        self.steps = OrderedDict()
+
+    def add(self, func, requires=(), name=None):
+        name = name or func.__name__
+        requires = [getattr(r, "__name__", r) for r in requires]
+
+        for dependency in requires:
+            if dependency not in self.steps:
+                raise PipelineError("Step {!r} requires unknown step {!r}"
+                        .format(name, dependency))
+
+        self.steps[name] = Step(name, func, requires)
+        return func
+
+    def order(self):
+        """Return step names in dependency order, rejecting cycles
+        """
+        ordered, visiting, seen = [], [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+
+            if name in visiting:
+                cycle = visiting[visiting.index(name):] + [name]
+                raise PipelineError("Dependency cycle: {}".format(
+                    " -> ".join(cycle)))
+
+            visiting.append(name)
+
+            for dependency in self.steps[name].requires:
+                visit(dependency)
+
+            visiting.pop()
+            seen.add(name)
+            ordered.append(name)
+
+        for name in self.steps:
+            visit(name)
+
+        return ordered
+
+    def run(self, concurrent=True):
+        """Run every step against the current host
+
+        Returns a dict of step name to (start, end) timestamps.
+        """
+        order = self.order()
+        timings = {}
+
+        if not concurrent:
+            for name in order:
+                start = time.time()
+                self.steps[name].func()
+                timings[name] = (start, time.time())
+
+            return timings
+
+        queue = multiprocessing.Queue()
+        pending = list(order)
+        running = {}
+        failures = []
+
+        while (pending and not failures) or running:
+            ready = [name for name in pending if not failures and all(
+                dependency in timings
+                for dependency in self.steps[name].requires)]
+
+            if not ready and not running:
+                raise PipelineError("No runnable steps left: {}".format(
+                    ", ".join(pending)))
+
+            if len(ready) == 1 and not running:
+                name = ready[0]
+                pending.remove(name)
+                start = time.time()
+                self.steps[name].func()
+                timings[name] = (start, time.time())
+                continue
+
+            for name in ready:
+                pending.remove(name)
+                process = multiprocessing.Process(target=_run_step,
+                        args=(self.steps[name].func, name, queue,
+                            dict(fabric.env)))
+                running[name] = (process, time.time())
+                process.start()
+
+            self._collect(queue, running, timings, failures)
+
+        if failures:
+            raise PipelineError("Pipeline steps failed on {}: {}".format(
+                fabric.env.host_string, ", ".join(failures)))
+
+        return timings
+
+    def _collect(self, queue, running, timings, failures):
+        try:
+            message = queue.get(timeout=self.POLL_INTERVAL)
+        except Empty:
+            # A child killed outright never reports back
+            for name, (process, start) in running.items():
+                if not process.is_alive() and process.exitcode != 0:
+                    del running[name]
+                    failures.append(name)
+            return
+
+        name = message["name"]
+        process, start = running.pop(name)
+        process.join()
+
+        merge_connection_stats(fabric.env.host_string, message["stats"])
+
+        if message["failed"]:
+            failures.append(name)
+        else:
+            fabric.env.update(message["env"])
+            timings[name] = (start, time.time())
+
+    def critical_path(self, timings):
+        """Return the chain of steps that decided the total run time
+        """
+        finish, previous = {}, {}
+
+        for name in self.order():
+            start, end = timings[name]
+            requires = self.steps[name].requires
+            slowest = max(requires, key=lambda r: finish[r]) if requires \
+                else None
+
+            previous[name] = slowest
+            finish[name] = (end - start) + (finish[slowest] if slowest else 0)
+
+        name = max(finish, key=finish.get)
+        path = []
+
+        while name:
+            path.append(name)
+            name = previous[name]
+
+        return list(reversed(path))
+
+    def print_report(self, timings):
+        path = self.critical_path(timings)
+        started = min(start for start, _ in timings.values())
+        ended = max(end for _, end in timings.values())
+
+        print colors.yellow("critical path on {}:".format(
+            fabric.env.host_string))
+
+        for name in path:
+            start, end = timings[name]
+            print "  {:<30} {:>8.1f}s  (+{:.1f}s)".format(name, end - start,
+                    start - started)
+
+        print "  {:<30} {:>8.1f}s  ({:.1f}s of step time)".format("total",
+                ended - started, sum(end - start for start, end in
+                    timings.values()))
+
+
+def _run_step(func, name, queue, env):
+    """Run a step in a forked process and report the result to the parent
+    """
+    state.env.update(env)
+    state.env.linewise = True
+
+    # Never share the parent's sockets, open our own connection instead
+    state.connections.clear()
+
+    before = dict(state.env)
+    before_stats = connection_stats(state.env.host_string)
+    message = {"name": name, "failed": False, "env": {}}
+
+    try:
+        func()
+    except BaseException as e:
+        message["failed"] = True
+
+        if e.__class__ is not SystemExit:
+            print colors.red("Step {} failed: {}".format(name, e))
+
+    for key, value in state.env.items():
+        if key in before and before[key] is value:
+            continue
+
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+
+        message["env"][key] = value
+
+    message["stats"] = dict((name, value - before_stats[name]) for
+            name, value in connection_stats(state.env.host_string).items())
+    queue.put(message)
@@ -0,0 +1,146 @@
+import json
+import posixpath
+
+import fabric.api as fabric
+
+from . import root_path, friendly_date
+from .migrations import get_release_meta, MANIFEST_DATE
+from .sync import file_sync
+
+
+RELEASE_INDEX = "releases/index.json"
+
+# Prints the index, or every manifest when a host has none yet
+READ_RELEASE_INDEX = """
+readlink {current} || echo
+if [ -f {index} ]; then
+    cat {index}
+else
+    for d in {releases}/*/; do
+        d=${{d%/}}
+        [ -f "$d/manifest.cfg" ] && echo "==> ${{d##*/}}" &&
+            cat "$d/manifest.cfg"
+    done
+fi
+"""
+
+
+def list_releases():
+    """Return the release current points at and every release's manifest date
+
+    Releases are returned oldest first as (name, date) tuples, date is None
+    for releases without a manifest, i.e. deploys that never finished or
+    are still running. All in one round trip.
+    """
+    output = fabric.run(
+        "readlink {current} || echo; "
+        "for d in {releases}/*/; do d=${{d%/}}; "
+        "echo \"${{d##*/}} $(sed -n 's/^date = //p' \"$d/manifest.cfg\" "
+        "2>/dev/null | head -n 1)\"; done".format(
+            current=root_path("current"), releases=root_path("releases")),
+        quiet=True)
+
+    lines = str(output).splitlines()
+    current = posixpath.basename(lines[0].strip().rstrip("/")) or None
+    releases = []
+
+    for line in lines[1:]:
+        parts = line.split(None, 1)
+
+        if parts and parts[0] != "*":
+            releases.append((parts[0], parts[1].strip() if len(parts) > 1
+                else None))
+
+    return current, sorted(releases)
+
+
+def prunable_releases(releases, current, to_keep):
+    """Pick the releases that can be removed
+
+    The newest to_keep finished releases (by manifest date) are kept, as
+    are current, the finished release before it (the rollback target) and
+    anything newer than current, which may be a deploy in progress.
+    Unfinished releases are only removed once a newer finished release
+    exists.
+    """
+    finished = [name for name, date in sorted(releases,
+        key=lambda r: (r[1], r[0])) if date]
+
+    keep = set(finished[-to_keep:] if to_keep > 0 else [])
+
+    if current:
+        keep.add(current)
+        older = [name for name in finished if name < current]
+
+        if older:
+            keep.add(older[-1])
+
+        keep.update(name for name, _ in releases if name > current)
+
+    newest = max(finished) if finished else None
+
+    return [name for name, date in releases if name not in keep
+            and (date or (newest and name < newest))]
+
+
+def parse_manifests(lines):
+    """Build an index from manifests listed as "==> name" and their content
+    """
+    index, name, manifest = {}, None, []
+
+    for line in lines + ["==> "]:
+        if line.startswith("==> "):
+            if name:
+                index[name] = get_release_meta("\n".join(manifest),
+                        friendly=False)
+
+            name, manifest = line[4:].strip(), []
+        else:
+            manifest.append(line)
+
+    return index
+
+
+def read_release_index():
+    """Return the release current points at and the host's release index
+
+    The index maps release names to their parsed manifests (see
+    get_release_meta), dates are kept as written in the manifest. Hosts
+    without one yet get it built from the releases' manifests. One round
+    trip either way.
+    """
+    output = fabric.run(READ_RELEASE_INDEX.format(
+        current=root_path("current"), index=root_path(RELEASE_INDEX),
+        releases=root_path("releases")), quiet=True)
+
+    lines = str(output).splitlines() or [""]
+    current = posixpath.basename(lines[0].strip().rstrip("/")) or None
+
+    if "".join(lines[1:]).strip().startswith("{"):
+        index = json.loads("\n".join(lines[1:]))
+    else:
+        index = parse_manifests(lines[1:])
+
+    return current, index
+
+
+def write_release_index(index):
+    with file_sync() as sync:
+        sync.add(root_path(RELEASE_INDEX), json.dumps(index, indent=2,
+            sort_keys=True, separators=(",", ": ")) + "\n", compare=False)
+
+
+def get_prior_release(current, index):
+    """Return the newest finished release older than current, if any
+    """
+    older = sorted(name for name in index if current and name < current)
+    return older[-1] if older else None
+
+
+def release_date(meta):
+    """Format an indexed release's date for display
+    """
+    try:
+        return friendly_date(meta["date"], MANIFEST_DATE)
+    except (KeyError, ValueError):
+        return meta.get("date", "-")
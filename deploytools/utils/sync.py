@@ -0,0 +1,202 @@
+import time
+import base64
+import hashlib
+import tarfile
+from StringIO import StringIO
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import fabric.api as fabric
+
+
+_active = []
+
+
+class SyncFile(object):
+
+    def __init__(self, path, content, mode=None, owner=None, compare=True,
+            secret=False):
+        self.path = path
+        self.content = content
+        self.mode = mode
+        self.owner = owner
+        self.compare = compare
+        self.secret = secret
+
+    @property
+    def checksum(self):
+        return hashlib.md5(self.content).hexdigest()
+
+    def matches(self, remote):
+        """Compare against a remote "mode owner checksum" line
+        """
+        if not self.compare or remote is None:
+            return False
+
+        mode, owner, checksum = remote.split(" ", 2)
+
+        if checksum != self.checksum:
+            return False
+
+        if self.mode is not None and int(mode, 8) != self.mode:
+            return False
+
+        if self.owner and not (owner == self.owner or
+                owner.split(":")[0] == self.owner):
+            return False
+
+        return True
+
+    def tarinfo(self):
+        info = tarfile.TarInfo(self.path.lstrip("/"))
+        info.size = len(self.content)
+        info.mode = 0644 if self.mode is None else self.mode
+        info.mtime = time.time()
+
+        if self.owner:
+            info.uname, _, info.gname = self.owner.partition(":")
+
+        return info
+
+
+class FileSync(object):
+    """Render files locally and upload only the ones that changed
+
+    Queued files are compared with the remote copies in a single round
+    trip (checksum, mode and owner) and whatever differs is sent as one
+    gzipped tar stream that is unpacked in place, keeping modes and, with
+    use_sudo, ownership. Tar replaces files instead of writing into them,
+    so files hardlinked between releases are never changed under an older
+    release. Small archives are sent inline with the extract command,
+    larger ones, and any containing secrets, are uploaded over SFTP first
+    so their content never shows up in a command line. Used as a context
+    manager the files are synced on exit.
+    """
+
+    INLINE_LIMIT = 64 * 1024
+
+    def __init__(self, use_sudo=False):
+        self.use_sudo = use_sudo
+        self.files = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def add(self, path, content, mode=None, owner=None, compare=True,
+            secret=False):
+        """Queue content for an absolute remote path
+
+        Files known to be new can skip the comparison with compare=False.
+        Files with secret=True are never sent inline.
+        """
+        if not path.startswith("/"):
+            raise ValueError("Synced paths must be absolute: {}".format(path))
+
+        self.files[path] = SyncFile(path, content, mode, owner, compare,
+                secret)
+        return path
+
+    def template(self, template, path, context, **kwargs):
+        # Same rendering as fabric's upload_template without jinja
+        with open(template) as fp:
+            return self.add(path, fp.read() % context, **kwargs)
+
+    def file(self, local_path, path, **kwargs):
+        if hasattr(local_path, "getvalue"):
+            return self.add(path, local_path.getvalue(), **kwargs)
+
+        with open(local_path, "rb") as fp:
+            return self.add(path, fp.read(), **kwargs)
+
+    def remote_state(self, files):
+        command = ("for f in {}; do if [ -f \"$f\" ]; then "
+                "echo \"$(stat -c '%a %U:%G' \"$f\") $(md5sum < \"$f\" | "
+                "cut -d' ' -f1)\"; else echo -; fi; done").format(
+                        " ".join("'{}'".format(f.path) for f in files))
+
+        output = self.runner(command, quiet=True).splitlines()
+
+        return dict((f.path, None if line.strip() == "-" else line.strip())
+                for f, line in zip(files, output))
+
+    @property
+    def runner(self):
+        return fabric.sudo if self.use_sudo else fabric.run
+
+    def archive(self, files):
+        output = StringIO()
+
+        with tarfile.open(fileobj=output, mode="w:gz") as tar:
+            for sync_file in files:
+                tar.addfile(sync_file.tarinfo(), StringIO(sync_file.content))
+
+        return output.getvalue()
+
+    def run(self):
+        files, self.files = self.files.values(), OrderedDict()
+
+        if not files:
+            return []
+
+        with fabric.settings(cwd=""):
+            compared = [f for f in files if f.compare]
+            remote = self.remote_state(compared) if compared else {}
+
+            changed = [f for f in files if not f.matches(remote.get(f.path))]
+
+            if not changed:
+                return []
+
+            data = self.archive(changed)
+            flags = "--same-owner " if self.use_sudo else ""
+
+            inline = len(data) <= self.INLINE_LIMIT and not any(
+                    f.secret for f in changed)
+
+            if inline:
+                with fabric.hide("running"):
+                    self.runner("echo {} | base64 -d | tar -xzpf - {}-C /"
+                            .format(base64.b64encode(data), flags))
+            else:
+                # Staged in a fresh 0700 directory so no other user can
+                # read the archive or plant something at its path
+                with fabric.hide("everything"):
+                    staging = fabric.run(
+                            "mktemp -d /tmp/deploytools-sync.XXXXXXXX")
+
+                upload = "{}/sync.tar.gz".format(staging)
+
+                try:
+                    fabric.put(StringIO(data), upload, mode=0600)
+                    self.runner("tar -xzpf {} {}-C /".format(upload, flags))
+                finally:
+                    fabric.run("rm -rf {}".format(staging), quiet=True)
+
+        return [f.path for f in changed]
+
+
+@contextmanager
+def file_sync(use_sudo=False):
+    """Share one FileSync between everything called inside the block
+
+    The outermost block owns the sync and runs it on exit, nested blocks
+    just queue onto it. Lets a task queue its files by itself and still
+    have them batched with other tasks when called from a larger step.
+    """
+    if _active and _active[-1].use_sudo == use_sudo:
+        yield _active[-1]
+        return
+
+    sync = FileSync(use_sudo)
+    _active.append(sync)
+
+    try:
+        yield sync
+    finally:
+        _active.remove(sync)
+
+    sync.run()
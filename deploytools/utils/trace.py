@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import zlib
+from functools import wraps
+
+import fabric.api as fabric
+from fabric.contrib import files
+
+
+_tracer = None
+
+
+class Tracer(object):
+    """Append timing events to a Chrome trace file
+
+    Events use the JSON array format, which chrome://tracing and Perfetto
+    both accept without the closing bracket. That means every event is a
+    single unbuffered append and forked workers (parallel hosts, pipeline
+    steps) can share the file without coordination. Each host is shown as
+    a process and each worker process as a thread within it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.named = set()
+
+        with open(path, "w") as fp:
+            fp.write("[\n")
+
+        self.fp = open(path, "a", 0)
+
+    @staticmethod
+    def host_pid(host):
+        return zlib.crc32(host) & 0xffff
+
+    def metadata(self, pid, tid, host):
+        if (pid, tid) in self.named:
+            return []
+
+        self.named.add((pid, tid))
+
+        return [
+            {"name": "process_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": host}},
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                "args": {"name": "worker {}".format(tid)}},
+        ]
+
+    def event(self, name, category, start, end, args):
+        host = fabric.env.host_string or "local"
+        pid, tid = self.host_pid(host), os.getpid()
+
+        args["host"] = host
+        events = self.metadata(pid, tid, host)
+        events.append({
+            "name": name, "cat": category, "ph": "X", "pid": pid,
+            "tid": tid, "ts": int(start * 1e6),
+            "dur": int((end - start) * 1e6), "args": args,
+        })
+
+        self.fp.write("".join(json.dumps(e) + ",\n" for e in events))
+
+
+def get_tracer():
+    return _tracer
+
+
+def _payload_size(local_path):
+    if hasattr(local_path, "getvalue"):
+        return len(local_path.getvalue())
+
+    try:
+        return os.path.getsize(local_path)
+    except (OSError, TypeError):
+        return 0
+
+
+def _measure_command(args, kwargs, result):
+    command = args[0] if args else kwargs.get("command", "")
+
+    return {
+        "command": command[:200],
+        "round_trips": 1,
+        "bytes_sent": len(command),
+        "bytes_received": len(result) if result is not None else 0,
+        "exit_status": getattr(result, "return_code", "error"),
+    }
+
+
+def _measure_put(args, kwargs, result):
+    local_path = args[0] if args else kwargs.get("local_path")
+
+    return {
+        "remote_path": str(args[1] if len(args) > 1 else
+            kwargs.get("remote_path")),
+        "round_trips": 1,
+        "bytes_sent": _payload_size(local_path),
+        "bytes_received": 0,
+        "exit_status": 0 if getattr(result, "succeeded", False) else "error",
+    }
+
+
+def traced_command(name, func, measure):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return func(*args, **kwargs)
+
+        start, result = time.time(), None
+
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            _tracer.event(name, "command", start, time.time(),
+                    measure(args, kwargs, result))
+
+    return wrapper
+
+
+def traced(func):
+    """Record the wall time of a task as a trace span when tracing is on
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if _tracer is None:
+            return func(*args, **kwargs)
+
+        start, status = time.time(), "failed"
+
+        try:
+            result = func(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            _tracer.event(func.__name__, "task", start, time.time(),
+                    {"exit_status": status})
+
+    return wrapper
+
+
+def install_tracer(path):
+    """Start writing a trace file and wrap fabric's remote operations
+
+    Tasks and helpers call fabric.api.run, sudo, put and
+    fabric.contrib.files.upload_template through their modules, so
+    wrapping the module attributes is enough to see every call.
+    """
+    global _tracer
+
+    if _tracer is None:
+        fabric.run = traced_command("run", fabric.run, _measure_command)
+        fabric.sudo = traced_command("sudo", fabric.sudo, _measure_command)
+        fabric.put = traced_command("put", fabric.put, _measure_put)
+        files.upload_template = traced_command("upload_template",
+                files.upload_template, _measure_put)
+
+    # Installing again only starts a new trace file
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def summarize_trace(path):
+    """Total round trips, bytes and command time per host from a trace file
+    """
+    with open(path) as fp:
+        data = fp.read().rstrip().rstrip(",")
+
+    hosts = {}
+
+    for event in json.loads(data + "]"):
+        if event.get("ph") != "X" or event.get("cat") != "command":
+            continue
+
+        args = event["args"]
+        totals = hosts.setdefault(args["host"], {"round_trips": 0,
+            "bytes_sent": 0, "bytes_received": 0, "seconds": 0.0})
+
+        totals["round_trips"] += args["round_trips"]
+        totals["bytes_sent"] += args["bytes_sent"]
+        totals["bytes_received"] += args["bytes_received"]
+        totals["seconds"] += event["dur"] / 1e6
+
+    return hosts
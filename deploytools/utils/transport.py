@@ -0,0 +1,160 @@
+import os
+import re
+import time
+import shutil
+import subprocess
+
+import fabric.api as fabric
+from fabric import colors
+from fabric.state import output
+from fabric.contrib import files
+from fabric.operations import (_AttributeString, _AttributeList,
+        _prefix_commands, _prefix_env_vars)
+
+
+class LocalTransport(object):
+    """Run fabric operations against local sandbox directories
+
+    Each host string gets its own directory under `sandbox`, which is used
+    as that host's home directory and working directory, so commands,
+    uploads and `~` paths all stay inside it. `latency` seconds are slept
+    before every operation to simulate the network. Privileged commands
+    sent through sudo are recorded in `sudo_log` instead of being run.
+    """
+
+    def __init__(self, sandbox, latency=0.0, path=None):
+        self.sandbox = os.path.abspath(sandbox)
+        self.latency = float(latency)
+        self.path = path or os.environ.get("PATH", "/usr/bin:/bin")
+        self.sudo_log = []
+
+    def host_root(self, host_string=None):
+        host = host_string or fabric.env.host_string or "localhost"
+        root = os.path.join(self.sandbox, re.sub(r"[^\w.-]", "_", host))
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+        return root
+
+    def _result(self, output, return_code, command):
+        result = _AttributeString(output)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        result.command = result.real_command = command
+        result.stderr = ""
+        return result
+
+    def _check(self, result, warn_only):
+        if result.failed and not (warn_only or fabric.env.warn_only):
+            fabric.abort(colors.red("Command failed ({}): {}".format(
+                result.return_code, result.command)))
+
+        return result
+
+    def run(self, command, shell=True, pty=True, combine_stderr=None,
+            quiet=False, warn_only=False, stdout=None, stderr=None,
+            timeout=None, shell_escape=None, capture_buffer_size=None):
+        time.sleep(self.latency)
+
+        root = self.host_root()
+        real_command = _prefix_commands(_prefix_env_vars(command), "remote")
+
+        if not quiet and output.running:
+            print "[{}] run: {}".format(fabric.env.host_string, command)
+
+        process = subprocess.Popen(["/bin/bash", "-c", real_command],
+                cwd=root, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                env={"HOME": root, "PATH": self.path, "USER":
+                    fabric.env.user or "", "LANG": "C"})
+
+        stdout = process.communicate()[0].rstrip("\n")
+
+        if not quiet and output.stdout:
+            for line in stdout.splitlines():
+                print "[{}] out: {}".format(fabric.env.host_string, line)
+
+        return self._check(self._result(stdout, process.returncode, command),
+                warn_only or quiet)
+
+    def sudo(self, command, shell=True, pty=True, combine_stderr=None,
+            user=None, quiet=False, warn_only=False, stdout=None,
+            stderr=None, group=None, timeout=None, shell_escape=None,
+            capture_buffer_size=None):
+        time.sleep(self.latency)
+        self.sudo_log.append((fabric.env.host_string, command))
+
+        if not quiet and output.running:
+            print "[{}] sudo (skipped): {}".format(fabric.env.host_string,
+                    command)
+
+        return self._result("", 0, command)
+
+    def put(self, local_path=None, remote_path=None, use_sudo=False,
+            mirror_local_mode=False, mode=None, use_glob=True, temp_dir=""):
+        time.sleep(self.latency)
+
+        root = self.host_root()
+        remote_path = remote_path.replace("~", root, 1) \
+            if remote_path.startswith("~") else remote_path
+        remote_path = os.path.join(root, fabric.env.cwd or "", remote_path)
+
+        if hasattr(local_path, "read"):
+            if os.path.isdir(remote_path):
+                remote_path = os.path.join(remote_path, "upload")
+
+            local_path.seek(0)
+            with open(remote_path, "wb") as fp:
+                fp.write(local_path.read())
+        else:
+            local_path = os.path.expanduser(local_path)
+
+            if os.path.isdir(remote_path):
+                remote_path = os.path.join(remote_path,
+                        os.path.basename(local_path))
+
+            shutil.copyfile(local_path, remote_path)
+
+            if mirror_local_mode and mode is None:
+                mode = os.stat(local_path).st_mode
+
+        if mode is not None:
+            os.chmod(remote_path, mode)
+
+        result = _AttributeList([remote_path])
+        result.failed = []
+        result.succeeded = True
+        return result
+
+    def get(self, remote_path, local_path=None, use_sudo=False, temp_dir=""):
+        time.sleep(self.latency)
+
+        root = self.host_root()
+        remote_path = os.path.join(root, fabric.env.cwd or "", remote_path)
+        local_path = local_path or os.path.basename(remote_path)
+
+        shutil.copyfile(remote_path, local_path)
+
+        result = _AttributeList([local_path])
+        result.failed = []
+        result.succeeded = True
+        return result
+
+
+def install_transport(transport):
+    """Route fabric's run, sudo, put and get through a transport
+
+    fabric.contrib.files keeps its own references to those functions, so
+    they are replaced there too and helpers such as upload_template and
+    append keep working. Install before the tracer so traces measure the
+    transport.
+    """
+    for module in (fabric, files):
+        module.run = transport.run
+        module.sudo = transport.sudo
+        module.put = transport.put
+
+    fabric.get = transport.get
+
+    return transport
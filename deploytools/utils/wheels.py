@@ -0,0 +1,163 @@
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import subprocess
+import multiprocessing
+
+import fabric.api as fabric
+from fabric import colors
+
+
+PINNED = re.compile(r"^([A-Za-z0-9_.-]+)==([^\s;#]+)")
+
+
+def _git(repo, *args):
+    return subprocess.check_output(["git"] + list(args), cwd=repo)
+
+
+def local_mirror():
+    """Return a local mirror of the project repo, fetching it first
+    """
+    cache = os.path.expanduser(os.path.join(
+        os.path.dirname(fabric.env.cfg.wheel_cache), "repos"))
+    mirror = os.path.join(cache, "{}.git".format(
+        hashlib.sha1(fabric.env.cfg.repo).hexdigest()))
+
+    if not os.path.isdir(mirror):
+        if not os.path.isdir(cache):
+            os.makedirs(cache)
+
+        subprocess.check_call(["git", "clone", "-q", "--mirror",
+            fabric.env.cfg.repo, mirror])
+    else:
+        _git(mirror, "fetch", "-q", "--prune", "origin")
+
+    return mirror
+
+
+def requirement_lines(requirements):
+    for line in requirements.splitlines():
+        line = line.split(" #", 1)[0].strip()
+
+        if line and not line.startswith(("#", "-")):
+            yield line
+
+
+def local_platform(python):
+    return subprocess.check_output([python, "-c",
+        "import sys, distutils.util; print('%s-cp%d%d' % (("
+        "distutils.util.get_platform().replace('-', '_').replace('.', '_'),)"
+        " + tuple(sys.version_info[:2])))"]).strip()
+
+
+def cached_wheel(cache, requirement):
+    """Return the cached wheel for a pinned requirement, None if missing
+    """
+    match = PINNED.match(requirement)
+
+    if not match:
+        return None
+
+    prefix = "{}-{}-".format(re.sub(r"[-.]+", "_", match.group(1)),
+            match.group(2)).lower()
+
+    for name in os.listdir(cache):
+        if name.lower().startswith(prefix) and name.endswith(".whl"):
+            return os.path.join(cache, name)
+
+
+def build_wheel(job):
+    """Build one requirement without its dependencies, in a pool worker
+    """
+    python, requirement, cache = job
+    scratch = tempfile.mkdtemp(prefix="deploy-wheel-")
+
+    try:
+        process = subprocess.Popen([python, "-m", "pip", "wheel", "-q",
+            "--no-deps", "--wheel-dir", scratch, requirement],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+
+        # Moved in once complete so concurrent builds never see partial
+        # files
+        for name in os.listdir(scratch):
+            os.rename(os.path.join(scratch, name), os.path.join(cache, name))
+
+        return requirement, process.returncode, output
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def build_wheelhouse(requirements):
+    """Build every wheel requirements.txt needs, on local cores
+
+    Wheels are cached in wheel_cache by platform tag, and within it by
+    name and version, so pinned requirements are only built once. Missing
+    ones are built in parallel, each without its dependencies, then a final
+    pip wheel pass resolves the whole file against the cache and fetches
+    anything still missing. The machine running the deploy must match the
+    hosts' platform and wheel_python their Python. Returns the wheels the
+    requirements resolve to.
+    """
+    python = fabric.env.cfg.wheel_python
+    cache = os.path.join(os.path.expanduser(fabric.env.cfg.wheel_cache),
+            local_platform(python))
+
+    if not os.path.isdir(cache):
+        os.makedirs(cache)
+
+    missing = [line for line in requirement_lines(requirements)
+            if not cached_wheel(cache, line)]
+
+    if missing:
+        print colors.yellow("Building {} wheels on {} cores".format(
+            len(missing), multiprocessing.cpu_count()))
+
+        pool = multiprocessing.Pool(min(len(missing),
+            multiprocessing.cpu_count()))
+
+        try:
+            results = pool.map(build_wheel, [(python, line, cache)
+                for line in missing])
+        finally:
+            pool.close()
+            pool.join()
+
+        for requirement, status, output in results:
+            if status != 0:
+                fabric.abort(colors.red("Building a wheel for {} failed:\n{}"
+                    .format(requirement, output)))
+
+    selected = tempfile.mkdtemp(prefix="deploy-wheelhouse-")
+    requirements_file = os.path.join(selected, "requirements.txt")
+
+    with open(requirements_file, "w") as fp:
+        fp.write(requirements)
+
+    pip = [python, "-m", "pip", "wheel", "-q", "--find-links", cache]
+
+    try:
+        # Copies exactly the wheels needed out of the cache, falling back
+        # to the index for dependencies that were never built
+        if subprocess.call(pip + ["--no-index", "--wheel-dir", selected,
+                "-r", requirements_file]) != 0:
+            subprocess.check_call(pip + ["--wheel-dir", cache, "-r",
+                requirements_file])
+            subprocess.check_call(pip + ["--no-index", "--wheel-dir",
+                selected, "-r", requirements_file])
+
+        return [os.path.join(cache, name) for name in os.listdir(selected)
+                if name.endswith(".whl")]
+    finally:
+        shutil.rmtree(selected, ignore_errors=True)
+
+
+def local_wheelhouse(sha):
+    """Build the wheels for the release's requirements.txt locally
+    """
+    mirror = local_mirror()
+    requirements = _git(mirror, "show", "{}:requirements.txt".format(sha))
+
+    return build_wheelhouse(requirements)